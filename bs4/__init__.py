@@ -23,6 +23,7 @@ __license__ = "MIT"
 
 __all__ = ['BeautifulSoup']
 
+import gc
 import os
 import re
 import warnings
@@ -31,6 +32,7 @@ from .builder import builder_registry, ParserRejectedMarkup
 from .dammit import UnicodeDammit
 from .element import (
     CData,
+    CSSSelector,
     Comment,
     DEFAULT_OUTPUT_ENCODING,
     Declaration,
@@ -41,6 +43,8 @@ from .element import (
     ResultSet,
     SoupStrainer,
     Tag,
+    TreeIndex,
+    compile_selector,
     )
 
 # The very first thing we do is give a useful error if someone is
@@ -80,10 +84,57 @@ class BeautifulSoup(Tag):
     NO_PARSER_SPECIFIED_WARNING = "No parser was explicitly specified, so I'm using the best available parser for this system (\"%(parser)s\"). This usually isn't a problem, but if you run this code on another system, or in a different virtual environment, it may use a different parser and behave differently.\n\nTo get rid of this warning, change this:\n\n BeautifulSoup([your markup])\n\nto this:\n\n BeautifulSoup([your markup], \"%(parser)s\")\n"
 
     def __init__(self, markup="", features=None, builder=None,
-                 parse_only=None, from_encoding=None, **kwargs):
+                 parse_only=None, from_encoding=None, cache_output=False,
+                 index_text=False, index_names=False,
+                 index_attributes=None, suspend_gc=False, **kwargs):
         """The Soup object is initialized as the 'root tag', and the
         provided markup (which can be a string or a file-like object)
-        is fed into the underlying parser."""
+        is fed into the underlying parser.
+
+        :param cache_output: If this is True, the tags in the tree
+           remember their output from the last time they were
+           rendered, and reuse it until they (or something beneath
+           them) are changed. This makes it much faster to output a
+           tree, or part of a tree, more than once, at the cost of
+           keeping a copy of the tags' output in memory.
+
+        :param index_text: If this is True, the first search for text
+           (such as find_all(text="foo")) indexes every string in the
+           tree by its value and by the words in it. From then on, a
+           search for a literal string, or for a regular expression
+           that starts with a word (like re.compile(r"\\bfoo")), only
+           looks at the strings the index turns up. The strings are
+           also listed the first time you ask for a tag's text,
+           instead of the second. The index is rebuilt after the tree
+           is changed.
+
+        :param index_names: If this is True, the tags in the tree are
+           indexed by name as they're parsed, and a search by tag name
+           (such as find_all('a') or soup.title) only looks at the
+           tags with that name. The index is rebuilt after the tree
+           is changed, or after a tag's .name is changed.
+
+        :param index_attributes: A list of attribute names, or True
+           for ['id', 'class']. The first search for a particular
+           value of one of these attributes (such as find(id="main")
+           or select(".item")) indexes the tags in the tree by their
+           values for that attribute, and from then on such a search
+           only looks at the tags the index turns up. The index is
+           rebuilt after the tree or any tag's attributes are
+           changed, including when a tag's .attrs is replaced
+           outright.
+
+        :param suspend_gc: If this is True, Python's cyclic garbage
+           collector is turned off while the document is parsed, and
+           turned back on afterwards. Everything made during parsing
+           ends up in the tree, so the collector would only spend its
+           time (and, for a big document, pause the program) looking
+           through the tree for garbage that isn't there. If the
+           collector was already off, it's left off. The collector is
+           shared by the whole process, so don't use this if other
+           threads might be turning it on and off, or depend on it
+           running, while the document is parsed.
+        """
 
         if 'convertEntities' in kwargs:
             warnings.warn(
@@ -164,6 +215,14 @@ class BeautifulSoup(Tag):
         self.builder.soup = self
 
         self.parse_only = parse_only
+        self.cache_output = cache_output
+        self.index_text = index_text
+        self.index_names = index_names
+        if index_attributes is True:
+            index_attributes = ['id', 'class']
+        elif isinstance(index_attributes, basestring):
+            index_attributes = [index_attributes]
+        self.index_attributes = frozenset(index_attributes or ())
 
         if hasattr(markup, 'read'):        # It's a file-type object.
             markup = markup.read()
@@ -200,15 +259,32 @@ class BeautifulSoup(Tag):
                     warnings.warn(
                         '"%s" looks like a URL. Beautiful Soup is not an HTTP client. You should probably use an HTTP client to get the document behind the URL, and feed that document to Beautiful Soup.' % markup)
 
-        for (self.markup, self.original_encoding, self.declared_html_encoding,
-         self.contains_replacement_characters) in (
-            self.builder.prepare_markup(markup, from_encoding)):
-            self.reset()
-            try:
-                self._feed()
-                break
-            except ParserRejectedMarkup:
-                pass
+        suspended = suspend_gc and gc.isenabled()
+        if suspended:
+            gc.disable()
+        try:
+            for (self.markup, self.original_encoding,
+                 self.declared_html_encoding,
+                 self.contains_replacement_characters) in (
+                self.builder.prepare_markup(markup, from_encoding)):
+                self.reset()
+                try:
+                    self._feed()
+                    break
+                except ParserRejectedMarkup:
+                    pass
+        finally:
+            if suspended:
+                gc.enable()
+
+        if index_text or index_names or self.index_attributes:
+            # Index the tree now, so every tag knows it's part of an
+            # indexed tree. Tags that went through handle_starttag()
+            # were recorded in document order; if there aren't any,
+            # the tree builder made the tree some other way, and it
+            # has to be walked.
+            TreeIndex(self, self._parsed_tags or None)
+        self._parsed_tags = None
 
         # Clear out the markup and remove the builder's circular
         # reference to this object.
@@ -226,6 +302,7 @@ class BeautifulSoup(Tag):
             self.popTag()
 
     def reset(self):
+        self._tree_changed()
         Tag.__init__(self, self, self.builder, self.ROOT_TAG_NAME)
         self.hidden = 1
         self.builder.reset()
@@ -233,8 +310,34 @@ class BeautifulSoup(Tag):
         self.currentTag = None
         self.tagStack = []
         self.preserve_whitespace_tag_stack = []
+        if self.index_text or self.index_names or self.index_attributes:
+            self._parsed_tags = []
+        else:
+            self._parsed_tags = None
         self.pushTag(self)
 
+    def dispose(self):
+        """Take the whole document apart, once you're done with it.
+
+        Every tag and string in the document is emptied out, so none
+        of them refer to each other any more, and the memory they use
+        is given back as soon as nothing else refers to them, rather
+        than whenever the garbage collector gets around to it. This
+        BeautifulSoup object is left empty, and you shouldn't use
+        anything you got out of it.
+        """
+        builder = self.__dict__.get('builder')
+        if builder is not None and builder.soup is self:
+            builder.soup = None
+        self.decompose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        """Leaving a 'with' block disposes of the document. See dispose()."""
+        self.dispose()
+
     def new_tag(self, name, namespace=None, nsprefix=None, **attrs):
         """Create a new tag associated with this soup."""
         return Tag(None, self.builder, name, namespace, nsprefix, attrs)
@@ -357,6 +460,8 @@ class BeautifulSoup(Tag):
         if self._most_recent_element:
             self._most_recent_element.next_element = tag
         self._most_recent_element = tag
+        if self._parsed_tags is not None:
+            self._parsed_tags.append(tag)
         self.pushTag(tag)
         return tag
 
@@ -368,20 +473,23 @@ class BeautifulSoup(Tag):
     def handle_data(self, data):
         self.current_data.append(data)
 
+    def _xml_declaration(self, eventual_encoding):
+        """The XML declaration that starts off an XML document, if any."""
+        if self.is_xml:
+            # Print the XML declaration
+            encoding_part = ''
+            if eventual_encoding != None:
+                encoding_part = ' encoding="%s"' % eventual_encoding
+            return u'<?xml version="1.0"%s?>\n' % encoding_part
+        return u''
+
     def decode(self, pretty_print=False,
                eventual_encoding=DEFAULT_OUTPUT_ENCODING,
                formatter="minimal"):
         """Returns a string or Unicode representation of this document.
         To get Unicode, pass None for encoding."""
 
-        if self.is_xml:
-            # Print the XML declaration
-            encoding_part = ''
-            if eventual_encoding != None:
-                encoding_part = ' encoding="%s"' % eventual_encoding
-            prefix = u'<?xml version="1.0"%s?>\n' % encoding_part
-        else:
-            prefix = u''
+        prefix = self._xml_declaration(eventual_encoding)
         if not pretty_print:
             indent_level = None
         else:
@@ -389,6 +497,21 @@ class BeautifulSoup(Tag):
         return prefix + super(BeautifulSoup, self).decode(
             indent_level, eventual_encoding, formatter)
 
+    def write(self, fp, encoding=DEFAULT_OUTPUT_ENCODING,
+              formatter="minimal", pretty_print=False,
+              errors="xmlcharrefreplace"):
+        """Writes this document to a file-like object, a chunk at a time.
+
+        See Tag.write() for details.
+        """
+        if not pretty_print:
+            indent_level = None
+        else:
+            indent_level = 0
+        self._write(
+            fp, indent_level, encoding, formatter, errors,
+            self._xml_declaration(encoding or DEFAULT_OUTPUT_ENCODING))
+
 # Alias to make it easier to type import: 'from bs4 import _soup'
 _s = BeautifulSoup
 _soup = BeautifulSoup
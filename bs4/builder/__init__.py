@@ -2,6 +2,7 @@ from collections import defaultdict
 import itertools
 import sys
 from bs4.element import (
+    AttributeValueList,
     CharsetMetaAttributeValue,
     ContentMetaAttributeValue,
     whitespace_re
@@ -162,7 +163,8 @@ class TreeBuilder(object):
                     # values. Split it into a list.
                     value = attrs[attr]
                     if isinstance(value, basestring):
-                        values = whitespace_re.split(value)
+                        values = AttributeValueList(
+                            whitespace_re.split(value))
                     else:
                         # html5lib sometimes calls setAttributes twice
                         # for the same tag when rearranging the parse
@@ -66,9 +66,16 @@ class EntitySubstitution(object):
             # But we do want to turn &quot; into the quotation mark.
             reverse_lookup[name] = character
         re_definition = "[%s]" % "".join(characters_for_re)
-        return lookup, reverse_lookup, re.compile(re_definition)
+        # A translation table for unicode.translate(), mapping each
+        # code point directly onto its finished entity.
+        translation_table = dict(
+            (ord(character), unicode("&%s;" % name))
+            for character, name in lookup.items())
+        return (lookup, reverse_lookup, re.compile(re_definition),
+                translation_table)
     (CHARACTER_TO_HTML_ENTITY, HTML_ENTITY_TO_CHARACTER,
-     CHARACTER_TO_HTML_ENTITY_RE) = _populate_class_variables()
+     CHARACTER_TO_HTML_ENTITY_RE,
+     CHARACTER_TO_HTML_ENTITY_TABLE) = _populate_class_variables()
 
     CHARACTER_TO_XML_ENTITY = {
         "'": "apos",
@@ -84,10 +91,15 @@ class EntitySubstitution(object):
 
     AMPERSAND_OR_BRACKET = re.compile("([<>&])")
 
+    # When at least one character in this many needs to become an
+    # entity, it's faster to run the whole string through
+    # unicode.translate() than to call back into Python for every
+    # regular expression match.
+    HTML_ENTITY_TRANSLATE_DENSITY = 5
+
     @classmethod
     def _substitute_html_entity(cls, matchobj):
-        entity = cls.CHARACTER_TO_HTML_ENTITY.get(matchobj.group(0))
-        return "&%s;" % entity
+        return cls.CHARACTER_TO_HTML_ENTITY_TABLE[ord(matchobj.group(0))]
 
     @classmethod
     def _substitute_xml_entity(cls, matchobj):
@@ -146,9 +158,11 @@ class EntitySubstitution(object):
         :param make_quoted_attribute: If True, then the string will be
          quoted, as befits an attribute value.
         """
-        # Escape angle brackets and ampersands.
-        value = cls.AMPERSAND_OR_BRACKET.sub(
-            cls._substitute_xml_entity, value)
+        # Escape angle brackets and ampersands. The ampersands must
+        # go first, so that the ampersands in the new entities are
+        # left alone.
+        value = value.replace("&", "&amp;").replace(
+            "<", "&lt;").replace(">", "&gt;")
 
         if make_quoted_attribute:
             value = cls.quoted_attribute_value(value)
@@ -168,9 +182,13 @@ class EntitySubstitution(object):
          quoted, as befits an attribute value.
         """
         # Escape angle brackets, and ampersands that aren't part of
-        # entities.
-        value = cls.BARE_AMPERSAND_OR_BRACKET.sub(
-            cls._substitute_xml_entity, value)
+        # entities. Only an ampersand needs the regular expression to
+        # decide whether it's part of an entity.
+        if "&" in value:
+            value = cls.BARE_AMPERSAND_OR_BRACKET.sub(
+                cls._substitute_xml_entity, value)
+        else:
+            value = value.replace("<", "&lt;").replace(">", "&gt;")
 
         if make_quoted_attribute:
             value = cls.quoted_attribute_value(value)
@@ -188,6 +206,17 @@ class EntitySubstitution(object):
         character with "&eacute;" will make it more readable to some
         people.
         """
+        if cls.CHARACTER_TO_HTML_ENTITY_RE.search(s) is None:
+            # Nothing to replace.
+            return s
+        if isinstance(s, unicode):
+            # Apart from the ampersand and the angle brackets, every
+            # character with a named entity is outside ASCII, so
+            # this is a cheap estimate of how many characters will
+            # be replaced.
+            non_ascii = len(s) - len(s.encode("ascii", "ignore"))
+            if non_ascii * cls.HTML_ENTITY_TRANSLATE_DENSITY >= len(s):
+                return s.translate(cls.CHARACTER_TO_HTML_ENTITY_TABLE)
         return cls.CHARACTER_TO_HTML_ENTITY_RE.sub(
             cls._substitute_html_entity, s)
 
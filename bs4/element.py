@@ -1,7 +1,15 @@
+from array import array
+import codecs
 import collections
+from itertools import ifilter, imap, islice
 import re
 import sys
+import threading
 import warnings
+import weakref
+from bisect import bisect_left, bisect_right
+import sre_constants
+import sre_parse
 from bs4.dammit import EntitySubstitution
 
 DEFAULT_OUTPUT_ENCODING = "utf-8"
@@ -81,6 +89,234 @@ class ContentMetaAttributeValue(AttributeValueWithCharsetSubstitution):
             return match.group(1) + encoding
         return self.CHARSET_RE.sub(rewrite, self.original_value)
 
+
+class AttributeValueList(list):
+    """The value of a multi-valued attribute like 'class'.
+
+    This acts like any other list, but when it's changed, it tells
+    the tag it belongs to. It can also be looked at as a set, which
+    is made once and kept until the list changes.
+    """
+
+    # A weak reference to the tag whose attributes this list is one
+    # of; see AttributeDict._claim(). It's weak so that the list
+    # doesn't keep the tag alive.
+    _tag = None
+
+    # The values as a frozenset; see value_set.
+    _value_set = None
+
+    # Whether every value is a Unicode string; see _unicode_set.
+    _unicode_only = None
+
+    def _owner(self):
+        """The tag this list belongs to, or None."""
+        if self._tag is None:
+            return None
+        return self._tag()
+
+    def _changed(self):
+        self._value_set = self._unicode_only = None
+        if self._tag is not None:
+            tag = self._tag()
+            if tag is not None:
+                attrs = tag.__dict__.get('attrs')
+                if isinstance(attrs, AttributeDict):
+                    attrs._changed()
+
+    def __getstate__(self):
+        # Neither the owner nor the sets are worth keeping.
+        return {}
+
+    @property
+    def value_set(self):
+        """The values, as a frozenset."""
+        if self._value_set is None:
+            self._value_set = frozenset(self)
+        return self._value_set
+
+    def _unicode_set(self):
+        """The values as a frozenset, if they're all Unicode strings.
+
+        Otherwise, None: checking whether something is in the set
+        might not give the same answer as comparing it to each value.
+        """
+        if self._unicode_only is None:
+            self._unicode_only = all(
+                isinstance(value, unicode) for value in self)
+        if self._unicode_only:
+            return self.value_set
+        return None
+
+    def __setitem__(self, index, value):
+        self._changed()
+        list.__setitem__(self, index, value)
+
+    def __delitem__(self, index):
+        self._changed()
+        list.__delitem__(self, index)
+
+    def __setslice__(self, i, j, sequence):
+        self._changed()
+        list.__setslice__(self, i, j, sequence)
+
+    def __delslice__(self, i, j):
+        self._changed()
+        list.__delslice__(self, i, j)
+
+    def __iadd__(self, other):
+        self._changed()
+        return list.__iadd__(self, other)
+
+    def __imul__(self, n):
+        self._changed()
+        return list.__imul__(self, n)
+
+    def append(self, value):
+        self._changed()
+        list.append(self, value)
+
+    def extend(self, values):
+        self._changed()
+        list.extend(self, values)
+
+    def insert(self, index, value):
+        self._changed()
+        list.insert(self, index, value)
+
+    def pop(self, *args):
+        self._changed()
+        return list.pop(self, *args)
+
+    def remove(self, value):
+        self._changed()
+        list.remove(self, value)
+
+    def reverse(self):
+        self._changed()
+        list.reverse(self)
+
+    def sort(self, *args, **kwargs):
+        self._changed()
+        list.sort(self, *args, **kwargs)
+
+    def clear(self):
+        # Python 3 lists have this method; Python 2 lists don't.
+        self._changed()
+        list.__delitem__(self, slice(None))
+
+    def copy(self):
+        """A copy of this list that doesn't belong to any
+        AttributeDict yet."""
+        return AttributeValueList(self)
+    __copy__ = copy
+
+
+class AttributeDict(dict):
+    """A dictionary of a tag's attributes.
+
+    This acts like any other dictionary, but it remembers the tag's
+    rendered start tag from the last time the tag was output, and
+    forgets it as soon as an attribute is added, changed or removed.
+    If it belongs to a tag, it also tells the tag about the change.
+
+    An AttributeValueList that doesn't already belong to some other
+    tag comes to belong to the same tag as this dictionary, so
+    changes to the list count as changes to the attributes.
+    """
+
+    # (formatter, encoding, name, prefix, is_empty_element,
+    #  [(list value, copy of list value), ...], start tag, weak
+    #  reference to the tag that owned the other list values)
+    _start_tag = None
+
+    # A weak reference to the tag these are the attributes of. It's
+    # only set once something relies on hearing about changes to the
+    # attributes; see _claim(). It's weak so that the tag and its
+    # attributes don't keep each other alive.
+    _tag = None
+
+    def __getstate__(self):
+        # The rendered start tag is not worth keeping, and the tag
+        # claims its attributes again when it needs to.
+        return {}
+
+    def _owner(self):
+        """The tag these are the attributes of, or None."""
+        if self._tag is None:
+            return None
+        return self._tag()
+
+    def _claim(self, tag):
+        """Make these the attributes of `tag`, unless they belong to
+        another tag already, so that `tag` hears about any change to
+        them or to one of their list values.
+
+        :return: Whether these are `tag`'s attributes.
+        """
+        if self._tag is not None:
+            owner = self._tag()
+            if owner is not None:
+                return owner is tag
+        # A list value may have been changed while nobody was
+        # listening.
+        self._start_tag = None
+        self._tag = weakref.ref(tag)
+        for value in self.itervalues():
+            self._adopt(value)
+        return True
+
+    def _adopt(self, value):
+        if (self._tag is not None
+            and value.__class__ is AttributeValueList
+            and value._owner() is None):
+            value._tag = self._tag
+
+    def _changed(self):
+        self._start_tag = None
+        if self._tag is not None:
+            tag = self._tag()
+            if tag is not None:
+                tag._output_changed()
+                tag._attributes_changed()
+
+    def __setitem__(self, key, value):
+        self._changed()
+        self._adopt(value)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._changed()
+        dict.__delitem__(self, key)
+
+    def clear(self):
+        self._changed()
+        dict.clear(self)
+
+    def pop(self, *args):
+        self._changed()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._changed()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self._changed()
+        self._adopt(default)
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        self._changed()
+        dict.update(self, *args, **kwargs)
+        for value in self.itervalues():
+            self._adopt(value)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+
 class HTMLAwareEntitySubstitution(EntitySubstitution):
 
     """Entity substitution rules that are aware of some HTML quirks.
@@ -116,6 +352,53 @@ class HTMLAwareEntitySubstitution(EntitySubstitution):
         return cls._substitute_if_appropriate(
             ns, EntitySubstitution.substitute_xml)
 
+
+class Formatter(object):
+    """Everything Beautiful Soup needs to know to output a tree as markup.
+
+    The "formatter" argument to methods like decode() and prettify()
+    may be a name ("html", "minimal", None), a function, or one of
+    these objects. Whatever it is, it's turned into a Formatter once,
+    when output begins, and that Formatter is passed down to every
+    element being output. This means the output code never has to
+    look up anything about the tree it's in.
+    """
+
+    def __init__(self, entity_substitution=None, is_xml=False,
+                 preformatted_tags=None, sort_attributes=True):
+        """Constructor.
+
+        :param entity_substitution: A function that will be called on
+           every string (and attribute value) that needs to undergo
+           entity substitution, or None to leave strings alone.
+        :param is_xml: Whether the tree being output is an XML tree.
+        :param preformatted_tags: The names of tags whose contents
+           should not be pretty-printed. By default this is <pre> for
+           HTML trees, and nothing for XML trees.
+        :param sort_attributes: If this is False, a tag's attributes
+           are output in the order the attribute dictionary gives
+           them, rather than in alphabetical order. On Pythons whose
+           dictionaries remember insertion order, that's the order in
+           which they appeared in the original document.
+        """
+        self.sort_attributes = sort_attributes
+        self.entity_substitution = entity_substitution
+        self.is_xml = is_xml
+        if preformatted_tags is None:
+            if is_xml:
+                preformatted_tags = set()
+            else:
+                preformatted_tags = (
+                    HTMLAwareEntitySubstitution.preformatted_tags)
+        self.preformatted_tags = preformatted_tags
+
+    def substitute(self, s):
+        """Performs entity substitution on the given string."""
+        if self.entity_substitution is None:
+            return s
+        return self.entity_substitution(s)
+
+
 class PageElement(object):
     """Contains the navigational information for some part of the page
     (either a tag or a piece of text)"""
@@ -132,6 +415,8 @@ class PageElement(object):
     #   faster than "minimal".
     # A function - This function will be called on every string that
     #  needs to undergo entity substitution.
+    # A Formatter - Gives complete control over the output. See the
+    #  Formatter class.
     #
 
     # In an HTML document, the default "html" and "minimal" functions
@@ -150,15 +435,45 @@ class PageElement(object):
         None : None
         }
 
+    _named_formatters = {}
+
+    # If the tree keeps its output around (see Tag._serialize), this
+    # is this element's output from the last time it was rendered.
+    _output = None
+
+    # If a TreeIndex has been built for the tree this tag is in, this
+    # is that index. (Only tags are marked; strings are covered by
+    # their parents.)
+    _index = None
+
     def format_string(self, s, formatter='minimal'):
         """Format the given string using the given formatter."""
-        if not callable(formatter):
-            formatter = self._formatter_for_name(formatter)
-        if formatter is None:
-            output = s
-        else:
-            output = formatter(s)
-        return output
+        if not isinstance(formatter, Formatter):
+            formatter = self._formatter(formatter)
+        return formatter.substitute(s)
+
+    def _formatter(self, formatter):
+        """Turn the "formatter" argument to an output method into a
+        Formatter object.
+
+        This is done once per output operation; the resulting object
+        is passed down to every element being output.
+        """
+        if isinstance(formatter, Formatter):
+            return formatter
+        is_xml = self._is_xml
+        if callable(formatter):
+            return Formatter(formatter, is_xml)
+        # Named formatters always map onto the same Formatter, so
+        # that rendered start tags can be reused from one output
+        # operation to the next.
+        key = (formatter, is_xml)
+        named = self._named_formatters.get(key)
+        if named is None:
+            named = Formatter(
+                self._formatter_for_name(formatter, is_xml), is_xml)
+            self._named_formatters[key] = named
+        return named
 
     @property
     def _is_xml(self):
@@ -169,22 +484,54 @@ class PageElement(object):
         the contents of <script> and <style> tags, or not). It's
         inefficient, but it should be called very rarely.
         """
-        if self.parent is None:
-            # This is the top-level object. It should have .is_xml set
-            # from tree creation. If not, take a guess--BS is usually
-            # used on HTML markup.
-            return getattr(self, 'is_xml', False)
-        return self.parent._is_xml
-
-    def _formatter_for_name(self, name):
+        top = self
+        while top.parent is not None:
+            top = top.parent
+        # This is the top-level object. It should have .is_xml set
+        # from tree creation. If not, take a guess--BS is usually
+        # used on HTML markup.
+        return getattr(top, 'is_xml', False)
+
+    def _formatter_for_name(self, name, is_xml=None):
         "Look up a formatter function based on its name and the tree."
-        if self._is_xml:
+        if is_xml is None:
+            is_xml = self._is_xml
+        if is_xml:
             return self.XML_FORMATTERS.get(
                 name, EntitySubstitution.substitute_xml)
         else:
             return self.HTML_FORMATTERS.get(
                 name, HTMLAwareEntitySubstitution.substitute_xml)
 
+    def _output_changed(self):
+        """Forget the saved output of this element and every element
+        above it, because this element has been changed.
+
+        A tag's output (or a note that it was rendered without being
+        saved) is only saved along with the output of everything
+        beneath it, so there's no need to go further up the tree once
+        we find a tag with nothing saved.
+        """
+        element = self
+        while element is not None and element._output is not None:
+            element._output = None
+            element = element.parent
+
+    def _tree_changed(self):
+        """Mark the index of this element's tree out of date, because
+        something has been added to or removed from this element."""
+        index = self._index
+        if index is not None and index.up_to_date:
+            index.changed()
+
+    def _attributes_changed(self):
+        """Mark the index of this element's tree out of date as far as
+        attribute values go, because this tag's attributes have
+        changed."""
+        index = self._index
+        if index is not None:
+            index.attributes_changed()
+
     def setup(self, parent=None, previous_element=None):
         """Sets up the initial relations between this element and
         other elements."""
@@ -214,12 +561,31 @@ class PageElement(object):
         return self
     replaceWith = replace_with  # BS3
 
+    def replace_with_many(self, replacements):
+        """Replace this element with a number of elements, in order.
+
+        This is like calling replace_with() with the first one and
+        insert_after() with the rest, but the tree is only patched up
+        once.
+        """
+        old_parent = self.parent
+        if old_parent is None:
+            raise ValueError(
+                "Element has no parent, so there's nothing to replace.")
+        replacements = list(replacements)
+        for replacement in replacements:
+            if replacement is old_parent:
+                raise ValueError("Cannot replace a Tag with its parent.")
+        my_index = old_parent.index(self)
+        self.extract()
+        old_parent.insert_many(my_index, replacements)
+        return self
+
     def unwrap(self):
         my_parent = self.parent
         my_index = self.parent.index(self)
         self.extract()
-        for child in reversed(self.contents[:]):
-            my_parent.insert(my_index, child)
+        my_parent.insert_many(my_index, self.contents[:])
         return self
     replace_with_children = unwrap
     replaceWithChildren = unwrap  # BS3
@@ -231,8 +597,16 @@ class PageElement(object):
 
     def extract(self):
         """Destructively rips this element out of the tree."""
-        if self.parent is not None:
-            del self.parent.contents[self.parent.index(self)]
+        parent = self.parent
+        if parent is not None:
+            # This is what _output_changed() and _tree_changed() do,
+            # without the method calls when there's nothing to forget.
+            if parent._output is not None:
+                parent._output_changed()
+            index = parent._index
+            if index is not None and index.up_to_date:
+                index.changed()
+            del parent.contents[parent.index(self)]
 
         #Find the two elements that would be next to each other if
         #this element (and any children) hadn't been parsed. Connect
@@ -332,11 +706,152 @@ class PageElement(object):
         if new_childs_last_element.next_element is not None:
             new_childs_last_element.next_element.previous_element = new_childs_last_element
         self.contents.insert(position, new_child)
+        self._output_changed()
+        self._tree_changed()
 
     def append(self, tag):
         """Appends the given tag to the contents of this tag."""
         self.insert(len(self.contents), tag)
 
+    def extend(self, tags):
+        """Appends the given tags to the contents of this tag."""
+        self.insert_many(len(self.contents), tags)
+
+    def insert_many(self, position, new_children):
+        """Insert a number of elements into this tag, one after another,
+        starting at the given position.
+
+        This has the same effect as calling insert() for each element
+        in turn, but the elements are taken out of wherever they were
+        and spliced into the tree in one go, rather than one at a time.
+        """
+        children = []
+        for new_child in new_children:
+            if new_child is self:
+                raise ValueError("Cannot insert a tag into itself.")
+            if (isinstance(new_child, basestring)
+                and not isinstance(new_child, NavigableString)):
+                new_child = NavigableString(new_child)
+            children.append(new_child)
+        if not children:
+            return
+
+        # An element that's in the list more than once ends up where
+        # it was inserted last, as it would with insert().
+        seen = set()
+        unique = []
+        for child in reversed(children):
+            if id(child) not in seen:
+                seen.add(id(child))
+                unique.append(child)
+        unique.reverse()
+        children = unique
+
+        # Take the elements out of the tags they're in now, one tag
+        # at a time.
+        position = min(position, len(self.contents))
+        old_parents = {}
+        for child in children:
+            parent = getattr(child, 'parent', None)
+            if parent is not None:
+                old_parents.setdefault(id(parent), (parent, []))[1].append(
+                    child)
+        for parent, moving in old_parents.values():
+            if parent is self:
+                # Moving elements that are before the insertion point
+                # moves the insertion point.
+                position -= len(
+                    [child for child in self.contents[:position]
+                     if id(child) in seen])
+            parent._remove_children(moving)
+
+        # Find the elements the new ones go between...
+        contents = self.contents
+        if position == 0:
+            previous_child = None
+            previous_element = self
+        else:
+            previous_child = contents[position - 1]
+            previous_element = previous_child._last_descendant(False)
+        if position < len(contents):
+            next_child = next_element = contents[position]
+        else:
+            next_child = next_element = None
+            parent = self
+            while next_element is None and parent is not None:
+                next_element = parent.next_sibling
+                parent = parent.parent
+
+        # ...and link them in.
+        for child in children:
+            child.parent = self
+            child.previous_sibling = previous_child
+            if previous_child is not None:
+                previous_child.next_sibling = child
+            child.previous_element = previous_element
+            previous_element.next_element = child
+            previous_child = child
+            previous_element = child._last_descendant(False)
+        previous_child.next_sibling = next_child
+        if next_child is not None:
+            next_child.previous_sibling = previous_child
+        previous_element.next_element = next_element
+        if next_element is not None:
+            next_element.previous_element = previous_element
+
+        contents[position:position] = children
+        self._output_changed()
+        self._tree_changed()
+
+    def _remove_children(self, children):
+        """Extract some of this tag's children in a single pass over
+        its contents.
+
+        Each child ends up just as if extract() had been called on it.
+        """
+        remove = set(map(id, children))
+        contents = self.contents
+        kept = []
+        i = 0
+        count = len(contents)
+        while i < count:
+            if id(contents[i]) not in remove:
+                kept.append(contents[i])
+                i += 1
+                continue
+            # contents[i:end] is a run of children to remove.
+            end = i + 1
+            while end < count and id(contents[end]) in remove:
+                end += 1
+            run = contents[i:end]
+            # The last element beneath each child in the run.
+            lasts = [child.previous_element for child in contents[i+1:end]]
+            lasts.append(run[-1]._last_descendant())
+
+            # Connect what's on either side of the run.
+            before = run[0].previous_element
+            after = lasts[-1].next_element
+            if before is not None:
+                before.next_element = after
+            if after is not None:
+                after.previous_element = before
+            previous_child = run[0].previous_sibling
+            next_child = run[-1].next_sibling
+            if previous_child is not None:
+                previous_child.next_sibling = next_child
+            if next_child is not None:
+                next_child.previous_sibling = previous_child
+
+            for child, last in zip(run, lasts):
+                child.parent = None
+                child.previous_element = None
+                last.next_element = None
+                child.previous_sibling = child.next_sibling = None
+            i = end
+        contents[:] = kept
+        self._output_changed()
+        self._tree_changed()
+
     def insert_before(self, predecessor):
         """Makes the given element the immediate predecessor of this one.
 
@@ -378,7 +893,7 @@ class PageElement(object):
     def find_next(self, name=None, attrs={}, text=None, **kwargs):
         """Returns the first item that matches the given criteria and
         appears after this Tag in the document."""
-        return self._find_one(self.find_all_next, name, attrs, text, **kwargs)
+        return self._find_one(self.ifind_all_next, name, attrs, text, **kwargs)
     findNext = find_next  # BS3
 
     def find_all_next(self, name=None, attrs={}, text=None, limit=None,
@@ -392,7 +907,7 @@ class PageElement(object):
     def find_next_sibling(self, name=None, attrs={}, text=None, **kwargs):
         """Returns the closest sibling to this Tag that matches the
         given criteria and appears after this Tag in the document."""
-        return self._find_one(self.find_next_siblings, name, attrs, text,
+        return self._find_one(self.ifind_next_siblings, name, attrs, text,
                              **kwargs)
     findNextSibling = find_next_sibling  # BS3
 
@@ -409,7 +924,7 @@ class PageElement(object):
         """Returns the first item that matches the given criteria and
         appears before this Tag in the document."""
         return self._find_one(
-            self.find_all_previous, name, attrs, text, **kwargs)
+            self.ifind_all_previous, name, attrs, text, **kwargs)
     findPrevious = find_previous  # BS3
 
     def find_all_previous(self, name=None, attrs={}, text=None, limit=None,
@@ -424,7 +939,7 @@ class PageElement(object):
     def find_previous_sibling(self, name=None, attrs={}, text=None, **kwargs):
         """Returns the closest sibling to this Tag that matches the
         given criteria and appears before this Tag in the document."""
-        return self._find_one(self.find_previous_siblings, name, attrs, text,
+        return self._find_one(self.ifind_previous_siblings, name, attrs, text,
                              **kwargs)
     findPreviousSibling = find_previous_sibling  # BS3
 
@@ -442,11 +957,9 @@ class PageElement(object):
         criteria."""
         # NOTE: We can't use _find_one because findParents takes a different
         # set of arguments.
-        r = None
-        l = self.find_parents(name, attrs, 1, **kwargs)
-        if l:
-            r = l[0]
-        return r
+        for r in self.ifind_parents(name, attrs, 1, **kwargs):
+            return r
+        return None
     findParent = find_parent  # BS3
 
     def find_parents(self, name=None, attrs={}, limit=None, **kwargs):
@@ -458,6 +971,42 @@ class PageElement(object):
     findParents = find_parents   # BS3
     fetchParents = find_parents  # BS2
 
+    # Lazy versions of the methods above. Each one returns an iterator
+    # that finds the next match when it's asked for one, so it
+    # doesn't look any further than it has to.
+
+    def ifind_all_next(self, name=None, attrs={}, text=None, limit=None,
+                       **kwargs):
+        """Like find_all_next(), but yields matches as they're found."""
+        return self._ifind_all(name, attrs, text, limit, self.next_elements,
+                               **kwargs)
+
+    def ifind_next_siblings(self, name=None, attrs={}, text=None, limit=None,
+                            **kwargs):
+        """Like find_next_siblings(), but yields matches as they're
+        found."""
+        return self._ifind_all(name, attrs, text, limit,
+                               self.next_siblings, **kwargs)
+
+    def ifind_all_previous(self, name=None, attrs={}, text=None, limit=None,
+                           **kwargs):
+        """Like find_all_previous(), but yields matches as they're
+        found."""
+        return self._ifind_all(name, attrs, text, limit,
+                               self.previous_elements, **kwargs)
+
+    def ifind_previous_siblings(self, name=None, attrs={}, text=None,
+                                limit=None, **kwargs):
+        """Like find_previous_siblings(), but yields matches as they're
+        found."""
+        return self._ifind_all(name, attrs, text, limit,
+                               self.previous_siblings, **kwargs)
+
+    def ifind_parents(self, name=None, attrs={}, limit=None, **kwargs):
+        """Like find_parents(), but yields matches as they're found."""
+        return self._ifind_all(name, attrs, None, limit, self.parents,
+                               **kwargs)
+
     @property
     def next(self):
         return self.next_element
@@ -469,11 +1018,9 @@ class PageElement(object):
     #These methods do the real heavy lifting.
 
     def _find_one(self, method, name, attrs, text, **kwargs):
-        r = None
-        l = method(name, attrs, text, 1, **kwargs)
-        if l:
-            r = l[0]
-        return r
+        for r in method(name, attrs, text, 1, **kwargs):
+            return r
+        return None
 
     def _find_all(self, name, attrs, text, limit, generator, **kwargs):
         "Iterates over a generator looking for things that match."
@@ -482,32 +1029,58 @@ class PageElement(object):
             strainer = name
         else:
             strainer = SoupStrainer(name, attrs, text, **kwargs)
+        return ResultSet(strainer, self._matches_from(
+            name, attrs, text, limit, generator, kwargs, strainer))
+
+    def _ifind_all(self, name, attrs, text, limit, generator, **kwargs):
+        "Iterates over a generator, yielding things that match."
+        return self._matches_from(
+            name, attrs, text, limit, generator, kwargs, None)
+
+    def _matches_from(self, name, attrs, text, limit, generator, kwargs,
+                      strainer):
+        """Make an iterator over the things a generator yields that
+        match, which stops after `limit` matches.
 
-        if text is None and not limit and not attrs and not kwargs:
+        :param strainer: The SoupStrainer for the search, if the caller
+         has already made one.
+        """
+        only_name = text is None and not attrs and not kwargs
+        # The shortcuts below ignore `attrs`. But a SoupStrainer takes
+        # any value for attrs other than a dictionary, even None or '',
+        # as a search on the 'class' attribute, so find('a', None) only
+        # finds an <a> tag with no class. Searches without a limit have
+        # always ignored that, and still do.
+        attrs_ignorable = isinstance(attrs, dict) or not limit
+        if only_name and attrs_ignorable:
             if name is True or name is None:
                 # Optimization to find all tags.
                 result = (element for element in generator
                           if isinstance(element, Tag))
-                return ResultSet(strainer, result)
+                if limit:
+                    result = islice(result, limit)
+                return result
             elif isinstance(name, basestring):
                 # Optimization to find all tags with a given name.
+                if isinstance(name, bytes):
+                    name = name.decode("utf8")
                 result = (element for element in generator
                           if isinstance(element, Tag)
                             and element.name == name)
-                return ResultSet(strainer, result)
-        results = ResultSet(strainer)
-        while True:
-            try:
-                i = next(generator)
-            except StopIteration:
-                break
-            if i:
-                found = strainer.search(i)
-                if found:
-                    results.append(found)
-                    if limit and len(results) >= limit:
-                        break
-        return results
+                if limit:
+                    result = islice(result, limit)
+                return result
+
+        if strainer is None:
+            if isinstance(name, SoupStrainer):
+                strainer = name
+            else:
+                strainer = SoupStrainer(name, attrs, text, **kwargs)
+        search = strainer._compile()
+        result = ifilter(None, imap(search, ifilter(None, generator)))
+        if limit:
+            result = islice(result, limit)
+        return result
 
     #These generators can be used to navigate starting from both
     #NavigableStrings and Tags.
@@ -546,6 +1119,117 @@ class PageElement(object):
             yield i
             i = i.parent
 
+    # Tag-only versions of the navigation attributes, which skip over
+    # strings.
+
+    @property
+    def next_tag(self):
+        """The first tag that comes after this element in the document."""
+        index = self._index
+        if index is not None and index.up_to_date:
+            tags = index._tags
+            position = index._tag_position(self) + 1
+            if position < len(tags):
+                return tags[position]
+            if index.root.parent is None:
+                return None
+        element = self.next_element
+        if element is None and isinstance(self, Tag) and self.contents:
+            # The BeautifulSoup object itself isn't linked to its
+            # first child.
+            element = self.contents[0]
+        while element is not None and not isinstance(element, Tag):
+            element = element.next_element
+        return element
+
+    @property
+    def next_tag_sibling(self):
+        """The first tag that comes after this element and has the
+        same parent."""
+        sibling = self.next_sibling
+        while sibling is not None and not isinstance(sibling, Tag):
+            sibling = sibling.next_sibling
+        return sibling
+
+    @property
+    def previous_tag_sibling(self):
+        """The last tag that comes before this element and has the same
+        parent."""
+        sibling = self.previous_sibling
+        while sibling is not None and not isinstance(sibling, Tag):
+            sibling = sibling.previous_sibling
+        return sibling
+
+    # Methods for comparing the positions of elements in a tree.
+
+    def is_ancestor_of(self, other):
+        """Is the given element somewhere beneath this one?
+
+        An element in a different tree, or in no tree at all, isn't.
+        """
+        try:
+            before, after = self._ordinals(other)
+        except ValueError:
+            return False
+        return (before[id(self)] < before[id(other)]
+                and after[id(self)] > after[id(other)])
+
+    def compare_document_position(self, other):
+        """Compare this element's position in the document with another
+        element's.
+
+        :return: A negative number if this element comes first, a
+         positive number if the other element comes first, and zero
+         if they're the same element.
+        """
+        before = self._ordinals(other)[0]
+        return before[id(self)] - before[id(other)]
+
+    def _ordinals(self, *others):
+        """Number this element's tree in document order.
+
+        :return: A 2-tuple of dictionaries mapping the id() of each
+         element to its position in a pre-order and a post-order walk
+         of the tree. The numbers are kept by the tree's TreeIndex, so
+         they're worked out again only after the tree changes.
+        :raise ValueError: If one of the other elements isn't in the
+         same tree as this one.
+        """
+        tag = self
+        if not isinstance(tag, Tag):
+            # A string that's never been put into a tree doesn't even
+            # have a .parent.
+            tag = getattr(self, 'parent', None)
+        if tag is not None:
+            index = tag._index
+            if index is not None and index.up_to_date:
+                ordinals = index.ordinals()
+                before = ordinals[0]
+                if id(self) in before and all(
+                    id(other) in before for other in others):
+                    return ordinals
+
+        if tag is None:
+            top = self
+        else:
+            top = tag
+            while top.parent is not None:
+                top = top.parent
+        if isinstance(top, Tag):
+            index = top._index
+            if index is None or not index.up_to_date or index.root is not top:
+                index = TreeIndex(top)
+            ordinals = index.ordinals()
+        else:
+            # A string on its own.
+            ordinals = {id(top): 0}, {id(top): 0}
+        before = ordinals[0]
+        for other in others:
+            if id(other) not in before:
+                raise ValueError(
+                    "%r is not in the same tree as %r" % (other, self))
+        return ordinals
+
     # Methods for supporting CSS selectors.
 
     tag_name_re = re.compile('^[a-zA-Z0-9][-.a-zA-Z0-9:_]*$')
@@ -581,7 +1265,8 @@ class PageElement(object):
                 return tag.name == tag_name and function(tag)
             return _match
 
-    def _attribute_checker(self, operator, attribute, value=''):
+    @staticmethod
+    def _attribute_checker(operator, attribute, value=''):
         """Create a function that performs a CSS selector operation.
 
         Takes an operator, attribute and optional value. Returns a
@@ -596,6 +1281,8 @@ class PageElement(object):
             # contains `value`
             def _includes_value(element):
                 attribute_value = element.get(attribute, [])
+                if attribute_value.__class__ is AttributeValueList:
+                    return value in attribute_value.value_set
                 if not isinstance(attribute_value, list):
                     attribute_value = attribute_value.split()
                 return value in attribute_value
@@ -738,6 +1425,41 @@ class Doctype(PreformattedString):
     SUFFIX = u'>\n'
 
 
+class _WatchedAttribute(object):
+    """A Tag attribute whose reassignment the tree's index and saved
+    output need to know about.
+
+    This has no __get__, so reading the attribute goes straight to
+    the tag's __dict__ as usual. Only setting it costs anything.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+    def __set__(self, tag, value):
+        state = tag.__dict__
+        if self.key in state:
+            if self.key == 'name':
+                tag._tree_changed()
+            elif self.key == 'attrs':
+                tag._release_attributes()
+                tag._attributes_changed()
+            tag._output_changed()
+        state[self.key] = value
+
+    def __delete__(self, tag):
+        state = tag.__dict__
+        if self.key not in state:
+            raise AttributeError(self.key)
+        if self.key == 'name':
+            tag._tree_changed()
+        elif self.key == 'attrs':
+            tag._release_attributes()
+            tag._attributes_changed()
+        tag._output_changed()
+        del state[self.key]
+
+
 class Tag(PageElement):
 
     """Represents a found HTML tag with its attributes and contents."""
@@ -746,38 +1468,72 @@ class Tag(PageElement):
                  prefix=None, attrs=None, parent=None, previous=None):
         "Basic constructor."
 
+        # The tag is new, so there's no need to go through
+        # _WatchedAttribute.
+        state = self.__dict__
         if parser is None:
-            self.parser_class = None
+            state['parser_class'] = None
         else:
             # We don't actually store the parser object: that lets extracted
             # chunks be garbage-collected.
-            self.parser_class = parser.__class__
+            state['parser_class'] = parser.__class__
         if name is None:
             raise ValueError("No value provided for new tag's name.")
-        self.name = name
-        self.namespace = namespace
-        self.prefix = prefix
+        state['name'] = name
+        state['namespace'] = namespace
+        state['prefix'] = prefix
         if attrs is None:
-            attrs = {}
+            attrs = AttributeDict()
         elif attrs and builder.cdata_list_attributes:
-            attrs = builder._replace_cdata_list_attribute_values(
-                self.name, attrs)
+            attrs = AttributeDict(
+                builder._replace_cdata_list_attribute_values(
+                    self.name, attrs))
         else:
-            attrs = dict(attrs)
-        self.attrs = attrs
-        self.contents = []
+            attrs = AttributeDict(attrs)
+        state['attrs'] = attrs
+        state['contents'] = []
         self.setup(parent, previous)
-        self.hidden = False
+        state['hidden'] = False
 
         # Set up any substitutions, such as the charset in a META tag.
         if builder is not None:
             builder.set_up_substitutions(self)
-            self.can_be_empty_element = builder.can_be_empty_element(name)
+            state['can_be_empty_element'] = builder.can_be_empty_element(
+                name)
         else:
-            self.can_be_empty_element = False
+            state['can_be_empty_element'] = False
 
     parserClass = _alias("parser_class")  # BS3
 
+    name = _WatchedAttribute('name')
+    prefix = _WatchedAttribute('prefix')
+    attrs = _WatchedAttribute('attrs')
+    hidden = _WatchedAttribute('hidden')
+
+    def _release_attributes(self):
+        """Stop listening for changes to this tag's attributes,
+        because .attrs is being replaced.
+
+        The new value is used as it is. If it's an AttributeDict that
+        doesn't belong to another tag, this tag will claim it when it
+        needs to; otherwise the tag is treated as though its
+        attributes could change at any time.
+        """
+        old = self.__dict__.get('attrs')
+        if isinstance(old, AttributeDict) and old._owner() is self:
+            # Changes to the old dictionary's list values won't
+            # reach it any more.
+            old._tag = old._start_tag = None
+
+    def __getstate__(self):
+        # Saved output is tied to Formatter objects, which can't
+        # necessarily be pickled. It's easy enough to recreate.
+        state = self.__dict__.copy()
+        state.pop('_output', None)
+        # Likewise for the tree index, which is rebuilt on demand.
+        state.pop('_index', None)
+        return state
+
     @property
     def is_empty_element(self):
         """Is this tag an empty-element tag? (aka a self-closing tag)
@@ -818,23 +1574,118 @@ class Tag(PageElement):
         self.clear()
         self.append(string.__class__(string))
 
+    # Strings beneath one of these tags are considered to be in a
+    # different block of text from the strings around the tag. See
+    # get_text().
+    block_elements = set([
+        'address', 'article', 'aside', 'blockquote', 'body', 'br',
+        'caption', 'dd', 'details', 'dialog', 'div', 'dl', 'dt',
+        'fieldset', 'figcaption', 'figure', 'footer', 'form', 'h1', 'h2',
+        'h3', 'h4', 'h5', 'h6', 'head', 'header', 'hgroup', 'hr', 'html',
+        'legend', 'li', 'main', 'nav', 'ol', 'option', 'p', 'pre',
+        'section', 'summary', 'table', 'tbody', 'td', 'tfoot', 'th',
+        'thead', 'title', 'tr', 'ul'])
+
+    # True if this tag's text has been extracted without an index
+    # since an index was last built for it; see _text_index.
+    _text_requested = False
+
+    def _text_index(self):
+        """Find an up-to-date TreeIndex to extract this tag's text
+        from, or None if the text should be gathered by walking the
+        tree.
+
+        Building an index costs more than one walk over the strings,
+        but it makes later text extraction from this tag (or any tag
+        beneath it) a matter of slicing a list. So an index is only
+        built if the tree was created with index_text, or if this
+        tag's text is asked for a second time.
+        """
+        index = self._index
+        if index is not None and not index.up_to_date:
+            index = None
+        if index is not None and index._strings is not None:
+            return index
+        text_index = self._search_index('index_text')
+        if text_index is not None:
+            return text_index
+        if not self._text_requested:
+            self._text_requested = True
+            return None
+        del self._text_requested
+        if index is None:
+            # Otherwise, the index that's already here (say, one made
+            # for index_names) can gather up the strings.
+            index = TreeIndex(self)
+        return index
+
+    def _text_nodes(self, types=(NavigableString, CData),
+                    block_elements=None):
+        """Yield the strings beneath this tag, in document order.
+
+        :param types: Only strings of these exact classes are
+         yielded. If this is None, all NavigableStrings are yielded.
+
+        :param block_elements: If this is a set of tag names, None is
+         yielded between two strings whenever one of those tags
+         starts or ends between them.
+        """
+        if block_elements is None:
+            # Nothing needs to know where the tags start and end, so
+            # just follow next_element.
+            if not self.contents:
+                return
+            stop = self._last_descendant().next_element
+            element = self.contents[0]
+            while element is not stop:
+                if isinstance(element, NavigableString) and (
+                    types is None or element.__class__ in types):
+                    yield element
+                element = element.next_element
+            return
+
+        stack = []
+        tag = self
+        children = iter(self.contents)
+        boundary = seen = False
+        while True:
+            for child in children:
+                if isinstance(child, NavigableString):
+                    if types is None or child.__class__ in types:
+                        if boundary and seen:
+                            yield None
+                        boundary = False
+                        seen = True
+                        yield child
+                    continue
+                if block_elements is not None and child.name in block_elements:
+                    boundary = True
+                stack.append((tag, children))
+                tag = child
+                children = iter(child.contents)
+                break
+            else:
+                if not stack:
+                    break
+                if block_elements is not None and tag.name in block_elements:
+                    boundary = True
+                tag, children = stack.pop()
+
     def _all_strings(self, strip=False, types=(NavigableString, CData)):
-        """Yield all strings of certain classes, possibly stripping them.
+        """Iterate over all strings of certain classes, possibly
+        stripping them.
 
         By default, yields only NavigableString and CData objects. So
         no comments, processing instructions, etc.
         """
-        for descendant in self.descendants:
-            if (
-                (types is None and not isinstance(descendant, NavigableString))
-                or
-                (types is not None and type(descendant) not in types)):
-                continue
-            if strip:
-                descendant = descendant.strip()
-                if len(descendant) == 0:
-                    continue
-            yield descendant
+        if types == TreeIndex.TEXT_TYPES:
+            index = self._text_index()
+            if index is not None:
+                return iter(index.strings_for(self, strip))
+        strings = self._text_nodes(types)
+        if strip:
+            strings = (s for s in (s.strip() for s in strings) if s)
+        return strings
 
     strings = property(_all_strings)
 
@@ -844,19 +1695,55 @@ class Tag(PageElement):
             yield string
 
     def get_text(self, separator=u"", strip=False,
-                 types=(NavigableString, CData)):
+                 types=(NavigableString, CData), block_separator=None):
         """
         Get all child strings, concatenated using the given separator.
+
+        :param block_separator: If this is provided, it's used instead
+         of `separator` between two strings that are separated by the
+         start or end of a block-level tag such as <p> or <br> (see
+         Tag.block_elements).
         """
-        return separator.join([s for s in self._all_strings(
-                    strip, types=types)])
+        if types == TreeIndex.TEXT_TYPES:
+            index = self._text_index()
+            if index is not None:
+                return index.get_text(self, separator, strip, block_separator)
+        if block_separator is None:
+            return separator.join(self._all_strings(strip, types))
+        return _join_blocks(
+            self._text_nodes(types, self.block_elements),
+            separator, strip, block_separator)
     getText = get_text
     text = property(get_text)
 
+    def text_buffer(self, separator=u""):
+        """Get all child strings as a TextBuffer: one string that can
+        be searched all at once, plus a map back to the
+        NavigableStrings it was made from.
+        """
+        index = self._text_index()
+        if index is None:
+            strings = list(self._text_nodes())
+        else:
+            strings = index.strings_for(self)
+        return TextBuffer(strings, separator)
+
     def decompose(self):
-        """Recursively destroys the contents of this tree."""
+        """Recursively destroys the contents of this tree.
+
+        Afterwards nothing in the tree refers to anything else, so it
+        can all be freed as soon as it's not used, without waiting for
+        the garbage collector to find the reference cycles.
+        """
         self.extract()
-        i = self
+        # A BeautifulSoup object's next_element is None, even when it
+        # has contents.
+        if self.contents:
+            i = self.contents[0]
+        else:
+            i = None
+        self.__dict__.clear()
+        self.contents = []
         while i is not None:
             next = i.next_element
             i.__dict__.clear()
@@ -867,15 +1754,14 @@ class Tag(PageElement):
         """
         Extract all children. If decompose is True, decompose instead.
         """
+        children = self.contents[:]
+        if not children:
+            return
+        self._remove_children(children)
         if decompose:
-            for element in self.contents[:]:
+            for element in children:
                 if isinstance(element, Tag):
                     element.decompose()
-                else:
-                    element.extract()
-        else:
-            for element in self.contents[:]:
-                element.extract()
 
     def index(self, element):
         """
@@ -913,6 +1799,21 @@ class Tag(PageElement):
         return len(self.contents)
 
     def __contains__(self, x):
+        """Is the given element a child of this tag?
+
+        This goes by identity, not value: a tag or string that's equal
+        to one of this tag's children, but isn't that child, isn't in
+        the tag. (Use contains_equal() for that.) Something that isn't
+        a PageElement, like an ordinary Unicode string, is compared by
+        value, since it can't be anyone's child. A NavigableString that
+        isn't in any tree isn't in this tag.
+        """
+        if isinstance(x, PageElement):
+            return getattr(x, 'parent', None) is self
+        return x in self.contents
+
+    def contains_equal(self, x):
+        """Is one of this tag's children equal to the given object?"""
         return x in self.contents
 
     def __nonzero__(self):
@@ -942,10 +1843,10 @@ class Tag(PageElement):
             warnings.warn(
                 '.%sTag is deprecated, use .find("%s") instead.' % (
                     tag_name, tag_name))
-            return self.find(tag_name)
+            return self._first_tag_named(tag_name)
         # We special case contents to avoid recursion.
         elif not tag.startswith("__") and not tag=="contents":
-            return self.find(tag)
+            return self._first_tag_named(tag)
         raise AttributeError(
             "'%s' object has no attribute '%s'" % (self.__class__, tag))
 
@@ -992,12 +1893,9 @@ class Tag(PageElement):
         u = self.decode(indent_level, encoding, formatter)
         return u.encode(encoding, errors)
 
-    def _should_pretty_print(self, indent_level):
-        """Should this tag be pretty-printed?"""
-        return (
-            indent_level is not None and
-            (self.name not in HTMLAwareEntitySubstitution.preformatted_tags
-             or self._is_xml))
+    # The number of pieces of output write() accumulates before
+    # writing them to the file.
+    WRITE_CHUNK_SIZE = 512
 
     def decode(self, indent_level=None,
                eventual_encoding=DEFAULT_OUTPUT_ENCODING,
@@ -1011,92 +1909,59 @@ class Tag(PageElement):
            document contains a <META> tag that mentions the document's
            encoding.
         """
+        return u''.join(
+            self._serialize(indent_level, eventual_encoding, formatter))
 
-        # First off, turn a string formatter into a function. This
-        # will stop the lookup from happening over and over again.
-        if not callable(formatter):
-            formatter = self._formatter_for_name(formatter)
-
-        attrs = []
-        if self.attrs:
-            for key, val in sorted(self.attrs.items()):
-                if val is None:
-                    decoded = key
-                else:
-                    if isinstance(val, list) or isinstance(val, tuple):
-                        val = ' '.join(val)
-                    elif not isinstance(val, basestring):
-                        val = unicode(val)
-                    elif (
-                        isinstance(val, AttributeValueWithCharsetSubstitution)
-                        and eventual_encoding is not None):
-                        val = val.encode(eventual_encoding)
-
-                    text = self.format_string(val, formatter)
-                    decoded = (
-                        unicode(key) + '='
-                        + EntitySubstitution.quoted_attribute_value(text))
-                attrs.append(decoded)
-        close = ''
-        closeTag = ''
-
-        prefix = ''
-        if self.prefix:
-            prefix = self.prefix + ":"
-
-        if self.is_empty_element:
-            close = '/'
+    def prettify(self, encoding=None, formatter="minimal"):
+        if encoding is None:
+            return self.decode(True, formatter=formatter)
         else:
-            closeTag = '</%s%s>' % (prefix, self.name)
+            return self.encode(encoding, True, formatter=formatter)
 
-        pretty_print = self._should_pretty_print(indent_level)
-        space = ''
-        indent_space = ''
-        if indent_level is not None:
-            indent_space = (' ' * (indent_level - 1))
+    def write(self, fp, encoding=DEFAULT_OUTPUT_ENCODING,
+              formatter="minimal", pretty_print=False,
+              errors="xmlcharrefreplace"):
+        """Writes this tag and its contents to a file-like object.
+
+        The output is the same as you'd get from encode() (or
+        prettify(), if pretty_print is True), but it's written to `fp`
+        a chunk at a time as it's generated, so the whole document
+        never has to be held in memory.
+
+        :param fp: Anything with a write() method, such as a file, a
+           socket's makefile() or an io.BytesIO.
+        :param encoding: The encoding to use for the bytestrings
+           written to `fp`. If this is None, Unicode strings are
+           written instead, exactly as decode() would produce them.
+        """
         if pretty_print:
-            space = indent_space
-            indent_contents = indent_level + 1
-        else:
-            indent_contents = None
-        contents = self.decode_contents(
-            indent_contents, eventual_encoding, formatter)
-
-        if self.hidden:
-            # This is the 'document root' object.
-            s = contents
+            indent_level = True
         else:
-            s = []
-            attribute_string = ''
-            if attrs:
-                attribute_string = ' ' + ' '.join(attrs)
-            if indent_level is not None:
-                # Even if this particular tag is not pretty-printed,
-                # we should indent up to the start of the tag.
-                s.append(indent_space)
-            s.append('<%s%s%s%s>' % (
-                    prefix, self.name, attribute_string, close))
-            if pretty_print:
-                s.append("\n")
-            s.append(contents)
-            if pretty_print and contents and contents[-1] != "\n":
-                s.append("\n")
-            if pretty_print and closeTag:
-                s.append(space)
-            s.append(closeTag)
-            if indent_level is not None and closeTag and self.next_sibling:
-                # Even if this particular tag is not pretty-printed,
-                # we're now done with the tag, and we should add a
-                # newline if appropriate.
-                s.append("\n")
-            s = ''.join(s)
-        return s
-
-    def prettify(self, encoding=None, formatter="minimal"):
+            indent_level = None
+        self._write(fp, indent_level, encoding, formatter, errors)
+
+    def _write(self, fp, indent_level, encoding, formatter, errors,
+               preamble=u''):
+        """Writes the output of _serialize() to `fp`, encoding it on the way."""
+        chunks = self._serialize(
+            indent_level, encoding or DEFAULT_OUTPUT_ENCODING, formatter,
+            chunk_size=self.WRITE_CHUNK_SIZE)
         if encoding is None:
-            return self.decode(True, formatter=formatter)
+            if preamble:
+                fp.write(preamble)
+            for chunk in chunks:
+                fp.write(chunk)
         else:
-            return self.encode(encoding, True, formatter=formatter)
+            # An incremental encoder makes sure that things like
+            # byte-order marks are only written once.
+            encoder = codecs.getincrementalencoder(encoding)(errors)
+            if preamble:
+                fp.write(encoder.encode(preamble))
+            for chunk in chunks:
+                fp.write(encoder.encode(chunk))
+            final = encoder.encode(u'', True)
+            if final:
+                fp.write(final)
 
     def decode_contents(self, indent_level=None,
                        eventual_encoding=DEFAULT_OUTPUT_ENCODING,
@@ -1110,29 +1975,389 @@ class Tag(PageElement):
            document contains a <META> tag that mentions the document's
            encoding.
         """
-        # First off, turn a string formatter into a function. This
-        # will stop the lookup from happening over and over again.
-        if not callable(formatter):
-            formatter = self._formatter_for_name(formatter)
-
-        pretty_print = (indent_level is not None)
-        s = []
-        for c in self:
-            text = None
-            if isinstance(c, NavigableString):
-                text = c.output_ready(formatter)
-            elif isinstance(c, Tag):
-                s.append(c.decode(indent_level, eventual_encoding,
-                                  formatter))
-            if text and indent_level and not self.name == 'pre':
-                text = text.strip()
-            if text:
-                if pretty_print and not self.name == 'pre':
-                    s.append(" " * (indent_level - 1))
-                s.append(text)
-                if pretty_print and not self.name == 'pre':
-                    s.append("\n")
-        return ''.join(s)
+        return u''.join(
+            self._serialize(indent_level, eventual_encoding, formatter,
+                            contents_only=True))
+
+    def _start_tag(self, eventual_encoding, formatter):
+        """Renders the opening tag (name and attributes) of this tag.
+
+        Rendering the attributes is the expensive part, so a tag's
+        AttributeDict remembers the result. It's reused as long as the
+        attributes, the tag's name and prefix, and the way the tag is
+        being output stay the same.
+        """
+        is_empty_element = self.is_empty_element
+        if not self.attrs:
+            if is_empty_element:
+                close = '/'
+            else:
+                close = ''
+            if self.prefix:
+                return '<%s:%s%s>' % (self.prefix, self.name, close)
+            return '<%s%s>' % (self.name, close)
+
+        cached = getattr(self.attrs, '_start_tag', None)
+        if (cached is not None
+            and cached[0] is formatter
+            and cached[1] == eventual_encoding
+            and cached[2] == self.name
+            and cached[3] == self.prefix
+            and cached[4] == is_empty_element
+            and (cached[7] is None or cached[7]() is self)):
+            # A list-valued attribute might have been changed in place.
+            for value, original in cached[5]:
+                if value != original:
+                    break
+            else:
+                return cached[6]
+
+        # List values that belong to this tag will tell it when
+        # they change.
+        owner = None
+        if isinstance(self.attrs, AttributeDict) and self.attrs._claim(self):
+            owner = self.attrs._tag
+        attrs = []
+        items = self.attrs.items()
+        if formatter.sort_attributes:
+            items = sorted(items)
+        # Copies of list-valued attributes that won't tell us when
+        # they change, so we can tell later on whether they have.
+        lists = []
+        cacheable = True
+        for key, val in items:
+            if val is None:
+                decoded = key
+            else:
+                if isinstance(val, list) or isinstance(val, tuple):
+                    if (isinstance(val, list)
+                        and (owner is None
+                             or val.__class__ is not AttributeValueList
+                             or val._owner() is not self)):
+                        lists.append((val, list(val)))
+                    val = ' '.join(val)
+                elif not isinstance(val, basestring):
+                    # There's no telling whether this object will
+                    # render the same way next time.
+                    cacheable = False
+                    val = unicode(val)
+                elif (
+                    isinstance(val, AttributeValueWithCharsetSubstitution)
+                    and eventual_encoding is not None):
+                    val = val.encode(eventual_encoding)
+
+                text = formatter.substitute(val)
+                decoded = (
+                    unicode(key) + '='
+                    + EntitySubstitution.quoted_attribute_value(text))
+            attrs.append(decoded)
+
+        prefix = ''
+        if self.prefix:
+            prefix = self.prefix + ":"
+        attribute_string = ' ' + ' '.join(attrs)
+        close = ''
+        if is_empty_element:
+            close = '/'
+        start_tag = '<%s%s%s%s>' % (
+            prefix, self.name, attribute_string, close)
+        if cacheable and isinstance(self.attrs, AttributeDict):
+            self.attrs._start_tag = (
+                formatter, eventual_encoding, self.name, self.prefix,
+                is_empty_element, lists, start_tag, owner)
+        return start_tag
+
+    def _output_can_be_saved(self):
+        """Will this tag find out about every change to its attributes?
+
+        That's true if its attributes are in an AttributeDict that
+        belongs to it, and every list-valued attribute is an
+        AttributeValueList that belongs to it too. This is only
+        accurate right after _start_tag() has been called.
+        """
+        attrs = self.attrs
+        if not isinstance(attrs, AttributeDict) or not attrs._claim(self):
+            return False
+        if self.hidden or not attrs:
+            return True
+        # _start_tag() notes down any attribute values that can change
+        # without telling anyone.
+        start_tag = attrs._start_tag
+        return start_tag is not None and not start_tag[5]
+
+    def _end_tag(self):
+        """Renders the closing tag of this tag, if it has one."""
+        if self.is_empty_element:
+            return ''
+        if self.prefix:
+            return '</%s:%s>' % (self.prefix, self.name)
+        return '</%s>' % self.name
+
+    def _serialize(self, indent_level=None,
+                   eventual_encoding=DEFAULT_OUTPUT_ENCODING,
+                   formatter="minimal", contents_only=False,
+                   chunk_size=None):
+        """Renders this tag (or just its contents) as Unicode strings.
+
+        Rather than recursing into every child tag and joining the
+        results together at every level, this makes a single pass
+        over the elements beneath this tag by following the
+        next_element chain. The tags that are currently open are kept
+        on an explicit stack, so there's no limit on how deeply the
+        tree can be nested, and each piece of the output is copied
+        only once.
+
+        Only non-empty strings go into the list of pieces. That lets
+        us tell whether a tag had any contents, and whether those
+        contents ended with a newline, by looking at the list itself.
+
+        If the tree was created with cache_output=True, the tags
+        that are rendered remember their output, and a tag whose
+        output is still good is copied into the output as a single
+        piece without looking at anything beneath it. The top of the
+        tree doesn't remember its output, and neither does a tag
+        whose output is mostly the output of one of its children
+        (such as a tag whose only child is a tag): that would be
+        another copy of the child's output, and it's little quicker
+        to reuse than the child's own. That way, each character of
+        the output is copied into only a few saved outputs, however
+        deeply the tree is nested.
+
+        :param chunk_size: If this is None, the entire output is
+           yielded as a single string. Otherwise, the output is
+           yielded a chunk at a time, whenever about this many
+           pieces have been accumulated.
+        """
+        # First off, turn the formatter argument into a Formatter
+        # object. This will stop the lookup from happening over and
+        # over again.
+        formatter = self._formatter(formatter)
+        preformatted_tags = formatter.preformatted_tags
+        substitute = formatter.substitute
+
+        top = self
+        while top.parent is not None:
+            top = top.parent
+        # Look in the instance dictionary, so that a detached tag
+        # doesn't go looking for a <cache_output> tag.
+        use_cache = top.__dict__.get('cache_output', False)
+        # A tag's output can only be saved if all of it is still in
+        # the list of pieces when the tag is closed.
+        save_output = use_cache and chunk_size is None
+        # The tags in the first this-many entries on the stack
+        # contain a tag whose output can't be saved, so their output
+        # can't be saved either.
+        unsaved = 0
+
+        if chunk_size is None:
+            chunk_size = sys.maxsize
+        pieces = []
+        append = pieces.append
+        # When a chunk of output is yielded, the list of pieces is
+        # emptied. Keep track of what it used to contain.
+        flushed = 0
+        last_flushed = u''
+        # While output is being saved, the number of characters in
+        # the first `counted` pieces.
+        written = counted = 0
+
+        # Each entry on the stack describes a tag that's been opened
+        # but not yet closed: (the tag, its closing tag, its indent
+        # level, whether the tag is pretty-printed, the indent level
+        # of its contents, how many pieces were output before its
+        # contents began, where in the list of pieces its output
+        # began, if it's going to be saved, how many characters had
+        # been written when it began, and the length of the longest
+        # output of one of its children so far). The closing tag is
+        # None if nothing should be output when the tag is closed.
+        # The entry for the most recently opened tag is kept in local
+        # variables instead.
+        stack = []
+        close_tag = tag_indent_level = tag_start = None
+        tag_written = largest_child = 0
+        pretty_print = False
+        contents_start = 0
+        if self.contents:
+            stop = self._last_descendant().next_element
+        else:
+            stop = None
+        if contents_only:
+            # Act as though this tag had already been opened, in a way
+            # that produces no output.
+            current = self
+            child_indent_level = indent_level
+            if self.contents:
+                element = self.contents[0]
+            else:
+                element = stop
+        else:
+            current = None
+            element = self
+
+        while True:
+            if len(pieces) >= chunk_size:
+                yield u''.join(pieces)
+                flushed += len(pieces)
+                last_flushed = pieces[-1]
+                del pieces[:]
+
+            if element is stop:
+                parent = None
+            else:
+                parent = element.parent
+            while current is not parent and current is not None:
+                # We're done with the most recently opened tag.
+                if close_tag is not None:
+                    if (pretty_print
+                        and flushed + len(pieces) > contents_start
+                        and (pieces and pieces[-1] or last_flushed)[-1]
+                        != "\n"):
+                        append("\n")
+                    if pretty_print and close_tag and tag_indent_level > 1:
+                        append(' ' * (tag_indent_level - 1))
+                    if close_tag:
+                        append(close_tag)
+                tag_size = None
+                if tag_start is not None:
+                    written += sum(map(len, pieces[counted:]))
+                    tag_size = written - tag_written
+                    if current.parent is None or largest_child * 2 > tag_size:
+                        # Don't keep this tag's output, but note that
+                        # it was rendered, so that a change beneath it
+                        # still reaches the tags above it.
+                        output = None
+                    else:
+                        output = u''.join(pieces[tag_start:])
+                        del pieces[tag_start:]
+                        if output:
+                            append(output)
+                    counted = len(pieces)
+                    current._output = (
+                        formatter, eventual_encoding, tag_indent_level,
+                        current.name, current.prefix, current.hidden,
+                        current.attrs, bool(close_tag), output)
+                if (close_tag and tag_indent_level is not None
+                    and current.next_sibling):
+                    # Even if this particular tag is not
+                    # pretty-printed, we're now done with the tag, and
+                    # we should add a newline if appropriate.
+                    append("\n")
+                if stack:
+                    (current, close_tag, tag_indent_level, pretty_print,
+                     child_indent_level, contents_start, tag_start,
+                     tag_written, largest_child) = stack.pop()
+                    if unsaved > len(stack):
+                        unsaved = len(stack)
+                        tag_start = None
+                    if tag_size is not None and tag_size > largest_child:
+                        largest_child = tag_size
+                else:
+                    current = None
+            if element is stop:
+                break
+
+            if isinstance(element, NavigableString):
+                if element.__class__ is NavigableString:
+                    # The most common case. This is what output_ready()
+                    # does, without the method call.
+                    text = substitute(element)
+                else:
+                    text = element.output_ready(formatter)
+                if text:
+                    if child_indent_level is None or parent.name == 'pre':
+                        append(text)
+                    else:
+                        if child_indent_level:
+                            text = text.strip()
+                        if text:
+                            if child_indent_level > 1:
+                                append(" " * (child_indent_level - 1))
+                            append(text)
+                            append("\n")
+            elif isinstance(element, Tag):
+                tag = element
+                if current is not None:
+                    new_indent_level = child_indent_level
+                else:
+                    # This is the tag we were asked to render.
+                    new_indent_level = indent_level
+                saved = use_cache and tag._output
+                if (saved
+                    and saved[8] is not None
+                    and saved[0] is formatter
+                    and saved[1] == eventual_encoding
+                    and saved[2] == new_indent_level
+                    and saved[3] == tag.name
+                    and saved[4] == tag.prefix
+                    and saved[5] == tag.hidden
+                    and saved[6] is tag.attrs):
+                    # This tag hasn't changed since the last time it
+                    # was output this way. Reuse that output and skip
+                    # over everything beneath the tag.
+                    if saved[8]:
+                        append(saved[8])
+                        if len(saved[8]) > largest_child:
+                            largest_child = len(saved[8])
+                    if (saved[7] and new_indent_level is not None
+                        and tag.next_sibling):
+                        append("\n")
+                    if tag is self:
+                        element = stop
+                    elif tag.next_sibling is not None:
+                        element = tag.next_sibling
+                    else:
+                        element = tag._last_descendant().next_element
+                    continue
+
+                if current is not None:
+                    stack.append((current, close_tag, tag_indent_level,
+                                  pretty_print, child_indent_level,
+                                  contents_start, tag_start,
+                                  tag_written, largest_child))
+                tag_indent_level = new_indent_level
+                current = tag
+                if save_output:
+                    tag_start = len(pieces)
+                    written += sum(map(len, pieces[counted:]))
+                    counted = tag_start
+                    tag_written = written
+                    largest_child = 0
+                else:
+                    tag_start = None
+                pretty_print = (
+                    tag_indent_level is not None and
+                    tag.name not in preformatted_tags)
+                if tag.hidden:
+                    close_tag = None
+                else:
+                    if tag_indent_level is not None and tag_indent_level > 1:
+                        # Even if this particular tag is not
+                        # pretty-printed, we should indent up to the
+                        # start of the tag.
+                        append(' ' * (tag_indent_level - 1))
+                    append(tag._start_tag(eventual_encoding, formatter))
+                    if pretty_print:
+                        append("\n")
+                    close_tag = tag._end_tag()
+                if tag_start is not None and not tag._output_can_be_saved():
+                    # We won't find out if this tag changes, so its
+                    # output can't be saved, and neither can the
+                    # output of any tag that contains it.
+                    tag_start = None
+                    unsaved = len(stack)
+                contents_start = flushed + len(pieces)
+                if pretty_print:
+                    child_indent_level = tag_indent_level + 1
+                else:
+                    child_indent_level = None
+            if element is not self:
+                element = element.next_element
+            elif self.contents:
+                element = self.contents[0]
+            else:
+                element = stop
+        if pieces:
+            yield u''.join(pieces)
 
     def encode_contents(
         self, indent_level=None, encoding=DEFAULT_OUTPUT_ENCODING,
@@ -1155,11 +2380,9 @@ class Tag(PageElement):
              **kwargs):
         """Return only the first child of this Tag matching the given
         criteria."""
-        r = None
-        l = self.find_all(name, attrs, recursive, text, 1, **kwargs)
-        if l:
-            r = l[0]
-        return r
+        for r in self.ifind_all(name, attrs, recursive, text, 1, **kwargs):
+            return r
+        return None
     findChild = find
 
     def find_all(self, name=None, attrs={}, recursive=True, text=None,
@@ -1173,13 +2396,296 @@ class Tag(PageElement):
         callable that takes a string and returns whether or not the
         string matches for some custom definition of 'matches'. The
         same is true of the tag name."""
+        name, generator = self._descendant_search(
+            name, attrs, recursive, text, kwargs, not limit)
+        return self._find_all(name, attrs, text, limit, generator, **kwargs)
+    findAll = find_all       # BS3
+    findChildren = find_all  # BS2
 
+    def ifind_all(self, name=None, attrs={}, recursive=True, text=None,
+                  limit=None, **kwargs):
+        """Like find_all(), but yields matches as they're found, and
+        stops looking when you stop asking for them."""
+        name, generator = self._descendant_search(
+            name, attrs, recursive, text, kwargs)
+        return self._ifind_all(name, attrs, text, limit, generator, **kwargs)
+
+    def _descendant_search(self, name, attrs, recursive, text, kwargs,
+                           exhaustive=False):
+        """Decide which elements a find_all() call should look at.
+
+        :param exhaustive: If this is True, every element will be
+         looked at, so it's worth listing the tags in the tree (see
+         descendant_tags) even if they haven't been listed yet.
+        :return: A 2-tuple (name, generator). The name may have been
+         turned into a SoupStrainer.
+        """
         generator = self.descendants
         if not recursive:
             generator = self.children
-        return self._find_all(name, attrs, text, limit, generator, **kwargs)
-    findAll = find_all       # BS3
-    findChildren = find_all  # BS2
+        elif self._index is not None or exhaustive:
+            # The tree may have been indexed for searching. See the
+            # index_text, index_names and index_attributes arguments
+            # to the BeautifulSoup constructor.
+            if ((text is not None or attrs or kwargs)
+                and not isinstance(name, SoupStrainer)):
+                name = SoupStrainer(name, attrs, text, **kwargs)
+            candidates = self._search_candidates(name)
+            if candidates is not None:
+                generator = iter(candidates)
+            elif isinstance(name, SoupStrainer):
+                if name.text is None:
+                    generator = self.descendant_tags
+            elif text is None:
+                # Only a tag can match this search.
+                generator = self.descendant_tags
+        return name, generator
+
+    def find_all_many(self, queries):
+        """Run a number of searches over this tag's descendants in a
+        single pass.
+
+        :param queries: A dictionary mapping keys of your choosing to
+         searches. A string is a CSS selector (a tag name on its own
+         is a selector too). A search can also be a SoupStrainer, or
+         anything else find_all() takes as its 'name' argument, such
+         as a list of tag names or a regular expression.
+        :return: A dictionary mapping the same keys to ResultSets,
+         each holding what find_all() or select() would have found.
+        """
+        results = {}
+        # Each search is a (matcher, callback) 2-tuple. A search that
+        # can only match tags with a certain name goes under that name;
+        # a CSS selector that can only match tags with a certain ID or
+        # class goes under that ID or class.
+        by_name = {}
+        by_id = {}
+        by_class = {}
+        # The searches that have to look at every tag.
+        any_tag = []
+        # The searches that can match strings.
+        strings = []
+
+        for key, query in queries.items():
+            if isinstance(query, (basestring, CSSSelector)):
+                if not isinstance(query, CSSSelector):
+                    query = compile_selector(query)
+                matchers = self._selector_matchers(query)
+                if matchers is None:
+                    # This selector can't be checked one tag at a time.
+                    results[key] = ResultSet(query, self.select(query))
+                    continue
+                results[key] = found = ResultSet(query)
+                def add(tag, found=found):
+                    # A tag that matches more than one comma-separated
+                    # part of the selector only shows up once.
+                    if not found or found[-1] is not tag:
+                        found.append(tag)
+                for tag_name, tag_id, klass, matcher in matchers:
+                    search = (matcher, add)
+                    if tag_name:
+                        by_name.setdefault(tag_name, []).append(search)
+                    elif tag_id is not None:
+                        by_id.setdefault(tag_id, []).append(search)
+                    elif klass is not None:
+                        by_class.setdefault(klass, []).append(search)
+                    else:
+                        any_tag.append(search)
+                continue
+
+            if isinstance(query, SoupStrainer):
+                strainer = query
+            else:
+                strainer = SoupStrainer(query)
+            results[key] = found = ResultSet(strainer)
+            search = (strainer._compile(), found.append)
+            name, attrs, text = strainer.name, strainer.attrs, strainer.text
+            if not text or name or attrs:
+                if isinstance(name, unicode) and name:
+                    by_name.setdefault(name, []).append(search)
+                else:
+                    any_tag.append(search)
+            elif text:
+                strings.append(search)
+
+        # A tag whose name isn't a Unicode string, or whose class
+        # isn't a list of strings, has to be checked against every
+        # search of that kind.
+        every_name = sum(by_name.values(), [])
+        every_class = sum(by_class.values(), [])
+
+        def run(searches, element):
+            for matcher, add in searches:
+                found = matcher(element)
+                if found:
+                    add(found)
+
+        if strings:
+            elements = self.descendants
+        else:
+            elements = self.descendant_tags
+        for element in elements:
+            if not isinstance(element, Tag):
+                if element:
+                    run(strings, element)
+                continue
+            name = element.name
+            if isinstance(name, unicode):
+                searches = by_name.get(name)
+                if searches is not None:
+                    run(searches, element)
+            else:
+                run(every_name, element)
+            if by_id or by_class:
+                get = element.attrs.get
+                if by_id:
+                    value = get('id')
+                    if isinstance(value, basestring):
+                        searches = by_id.get(value)
+                        if searches is not None:
+                            run(searches, element)
+                if by_class:
+                    value = get('class')
+                    if value is None:
+                        pass
+                    elif value.__class__ is AttributeValueList:
+                        for item in value.value_set:
+                            searches = by_class.get(item)
+                            if searches is not None:
+                                run(searches, element)
+                    elif (isinstance(value, list) and all(
+                            isinstance(item, basestring) for item in value)):
+                        for item in set(value):
+                            searches = by_class.get(item)
+                            if searches is not None:
+                                run(searches, element)
+                    else:
+                        run(every_class, element)
+            run(any_tag, element)
+
+        return results
+
+    def _search_index(self, option):
+        """Find an up-to-date TreeIndex for this tag's tree, if the
+        tree was created with the given BeautifulSoup constructor
+        argument (such as index_names) set to True.
+        """
+        index = self._index
+        if index is not None and index.up_to_date:
+            if index.root.__dict__.get(option, False):
+                return index
+            if index.root.parent is None:
+                # This index covers the whole tree, and the tree
+                # wasn't created with the option set.
+                return None
+        top = self
+        while top.parent is not None:
+            top = top.parent
+        if not top.__dict__.get(option, False):
+            return None
+        index = top._index
+        if index is None or not index.up_to_date or index.root is not top:
+            index = TreeIndex(top)
+        return index
+
+    def _search_candidates(self, name):
+        """Use the tree's indexes to find the elements beneath this
+        tag that might match a search.
+
+        :param name: The 'name' argument to find_all(), or a
+         SoupStrainer.
+        :return: A list of elements in document order, or None if the
+         whole tree needs to be searched.
+        """
+        if isinstance(name, SoupStrainer):
+            if name.text:
+                candidates = self._text_search_candidates(name)
+                if candidates is not None:
+                    return candidates
+            if name.attrs:
+                candidates = self._attribute_search_candidates(name.attrs)
+                if candidates is not None:
+                    return candidates
+            name = name.name
+        if not name:
+            return None
+        if not isinstance(name, basestring):
+            if (not isinstance(name, list)
+                or not all(isinstance(item, basestring) for item in name)):
+                return None
+        index = self._search_index('index_names')
+        if index is None:
+            return None
+        return index.tag_candidates(self, name)
+
+    def _text_search_candidates(self, strainer):
+        """Use the tree's text index to find the elements beneath this
+        tag that might match a strainer with a text condition.
+        """
+        index = self._search_index('index_text')
+        if index is None:
+            return None
+        strings = index.text_candidates(self, strainer.text)
+        if strings is None or not (strainer.name or strainer.attrs):
+            return strings
+
+        # We're looking for tags whose .string matches, so the
+        # candidates are the tags above each string that have no
+        # other children.
+        candidates = []
+        for string in strings:
+            tags = []
+            tag = string.parent
+            while tag is not self and len(tag.contents) == 1:
+                tags.append(tag)
+                tag = tag.parent
+            candidates.extend(reversed(tags))
+        return candidates
+
+    def _attribute_search_candidates(self, attrs):
+        """Use the tree's attribute indexes to find the tags beneath
+        this tag that might match a strainer's attribute conditions.
+
+        Only conditions that are a non-empty string or a list of
+        strings can be looked up. If more than one can, the one that
+        turns up the fewest tags is used.
+        """
+        best = None
+        for attribute, match_against in attrs.items():
+            all_of = ()
+            if isinstance(match_against, unicode):
+                if not match_against:
+                    # An empty string matches tags without the attribute.
+                    continue
+                any_of = [match_against]
+                if ' ' in match_against:
+                    # "foo bar" also matches a multi-valued attribute
+                    # whose values are "foo" and "bar".
+                    all_of = whitespace_re.split(match_against)
+            elif (isinstance(match_against, list) and match_against
+                  and all(isinstance(item, unicode)
+                          for item in match_against)):
+                any_of = match_against
+            else:
+                continue
+            candidates = self._attribute_candidates(attribute, any_of, all_of)
+            if candidates is not None and (
+                best is None or len(candidates) < len(best)):
+                best = candidates
+        return best
+
+    def _attribute_candidates(self, attribute, any_of=(), all_of=()):
+        """Use the tree's index of an attribute to find the tags beneath
+        this tag that might have one of the values in `any_of`, or
+        all of the values in `all_of`.
+
+        :return: A list of tags in document order, or None if the
+         attribute isn't indexed.
+        """
+        index = self._search_index('index_attributes')
+        if index is None or attribute not in index.root.index_attributes:
+            return None
+        return index.attribute_candidates(self, attribute, any_of, all_of)
 
     #Generator methods
     @property
@@ -1197,220 +2703,112 @@ class Tag(PageElement):
             yield current
             current = current.next_element
 
-    # CSS selector code
-
-    _selector_combinators = ['>', '+', '~']
-    _select_debug = False
-    def select(self, selector, _candidate_generator=None):
-        """Perform a CSS selection operation on the current element."""
-
-        # Remove whitespace directly after the grouping operator ','
-        # then split into tokens.
-        tokens = re.sub(',[\s]*',',', selector).split()
-        current_context = [self]
-
-        if tokens[-1] in self._selector_combinators:
-            raise ValueError(
-                'Final combinator "%s" is missing an argument.' % tokens[-1])
-
-        if self._select_debug:
-            print 'Running CSS selector "%s"' % selector
-
-        for index, token_group in enumerate(tokens):
-            new_context = []
-            new_context_ids = set([])
-
-            # Grouping selectors, ie: p,a
-            grouped_tokens = token_group.split(',')
-            if '' in grouped_tokens:
-                raise ValueError('Invalid group selection syntax: %s' % token_group)
+    @property
+    def descendant_tags(self):
+        """Iterate over the tags beneath this one, skipping the strings.
+
+        The first time this is used (or the first time after the tree
+        changes), the tags beneath this one are listed in document
+        order, which costs less than one walk over the tree. Until
+        the tree changes again, this tag and the tags beneath it use
+        that list, and never look at a string.
+        """
+        index = self._index
+        if index is None or not index.up_to_date:
+            index = TreeIndex(self)
+        if self is index.root:
+            return iter(index._tags)
+        start, end = index._tag_range(self)
+        return iter(index._tags[start:end])
+
+    def _first_tag_named(self, name):
+        """Find the first tag beneath this one with the given name.
+
+        This is the same as find(name), but it's what tag.name
+        lookups like soup.body.p use, so it skips making a search.
+        """
+        if not self.contents:
+            return None
+        index = self._search_index('index_names')
+        if index is not None:
+            return index.first_tag_named(self, name)
+        # The element after the last one beneath this tag.
+        node = self
+        while node is not None and node.next_sibling is None:
+            node = node.parent
+        stop = None
+        if node is not None:
+            stop = node.next_sibling
+        element = self.contents[0]
+        while element is not stop:
+            if element.name == name and isinstance(element, Tag):
+                return element
+            element = element.next_element
+        return None
 
-            if tokens[index-1] in self._selector_combinators:
-                # This token was consumed by the previous combinator. Skip it.
-                if self._select_debug:
-                    print '  Token was consumed by the previous combinator.'
-                continue
+    # CSS selector code
 
-            for token in grouped_tokens:
-                if self._select_debug:
-                    print ' Considering token "%s"' % token
-                recursive_candidate_generator = None
-                tag_name = None
-
-                # Each operation corresponds to a checker function, a rule
-                # for determining whether a candidate matches the
-                # selector. Candidates are generated by the active
-                # iterator.
-                checker = None
-
-                m = self.attribselect_re.match(token)
-                if m is not None:
-                    # Attribute selector
-                    tag_name, attribute, operator, value = m.groups()
-                    checker = self._attribute_checker(operator, attribute, value)
-
-                elif '#' in token:
-                    # ID selector
-                    tag_name, tag_id = token.split('#', 1)
-                    def id_matches(tag):
-                        return tag.get('id', None) == tag_id
-                    checker = id_matches
-
-                elif '.' in token:
-                    # Class selector
-                    tag_name, klass = token.split('.', 1)
-                    classes = set(klass.split('.'))
-                    def classes_match(candidate):
-                        return classes.issubset(candidate.get('class', []))
-                    checker = classes_match
-
-                elif ':' in token:
-                    # Pseudo-class
-                    tag_name, pseudo = token.split(':', 1)
-                    if tag_name == '':
-                        raise ValueError(
-                            "A pseudo-class must be prefixed with a tag name.")
-                    pseudo_attributes = re.match('([a-zA-Z\d-]+)\(([a-zA-Z\d]+)\)', pseudo)
-                    found = []
-                    if pseudo_attributes is not None:
-                        pseudo_type, pseudo_value = pseudo_attributes.groups()
-                        if pseudo_type == 'nth-of-type':
-                            try:
-                                pseudo_value = int(pseudo_value)
-                            except:
-                                raise NotImplementedError(
-                                    'Only numeric values are currently supported for the nth-of-type pseudo-class.')
-                            if pseudo_value < 1:
-                                raise ValueError(
-                                    'nth-of-type pseudo-class value must be at least 1.')
-                            class Counter(object):
-                                def __init__(self, destination):
-                                    self.count = 0
-                                    self.destination = destination
-
-                                def nth_child_of_type(self, tag):
-                                    self.count += 1
-                                    if self.count == self.destination:
-                                        return True
-                                    if self.count > self.destination:
-                                        # Stop the generator that's sending us
-                                        # these things.
-                                        raise StopIteration()
-                                    return False
-                            checker = Counter(pseudo_value).nth_child_of_type
-                        else:
-                            raise NotImplementedError(
-                                'Only the following pseudo-classes are implemented: nth-of-type.')
-
-                elif token == '*':
-                    # Star selector -- matches everything
-                    pass
-                elif token == '>':
-                    # Run the next token as a CSS selector against the
-                    # direct children of each tag in the current context.
-                    recursive_candidate_generator = lambda tag: tag.children
-                elif token == '~':
-                    # Run the next token as a CSS selector against the
-                    # siblings of each tag in the current context.
-                    recursive_candidate_generator = lambda tag: tag.next_siblings
-                elif token == '+':
-                    # For each tag in the current context, run the next
-                    # token as a CSS selector against the tag's next
-                    # sibling that's a tag.
-                    def next_tag_sibling(tag):
-                        yield tag.find_next_sibling(True)
-                    recursive_candidate_generator = next_tag_sibling
-
-                elif self.tag_name_re.match(token):
-                    # Just a tag name.
-                    tag_name = token
-                else:
-                    raise ValueError(
-                        'Unsupported or invalid CSS selector: "%s"' % token)
-                if recursive_candidate_generator:
-                    # This happens when the selector looks like  "> foo".
-                    #
-                    # The generator calls select() recursively on every
-                    # member of the current context, passing in a different
-                    # candidate generator and a different selector.
-                    #
-                    # In the case of "> foo", the candidate generator is
-                    # one that yields a tag's direct children (">"), and
-                    # the selector is "foo".
-                    next_token = tokens[index+1]
-                    def recursive_select(tag):
-                        if self._select_debug:
-                            print '    Calling select("%s") recursively on %s %s' % (next_token, tag.name, tag.attrs)
-                            print '-' * 40
-                        for i in tag.select(next_token, recursive_candidate_generator):
-                            if self._select_debug:
-                                print '(Recursive select picked up candidate %s %s)' % (i.name, i.attrs)
-                            yield i
-                        if self._select_debug:
-                            print '-' * 40
-                    _use_candidate_generator = recursive_select
-                elif _candidate_generator is None:
-                    # By default, a tag's candidates are all of its
-                    # children. If tag_name is defined, only yield tags
-                    # with that name.
-                    if self._select_debug:
-                        if tag_name:
-                            check = "[any]"
-                        else:
-                            check = tag_name
-                        print '   Default candidate generator, tag name="%s"' % check
-                    if self._select_debug:
-                        # This is redundant with later code, but it stops
-                        # a bunch of bogus tags from cluttering up the
-                        # debug log.
-                        def default_candidate_generator(tag):
-                            for child in tag.descendants:
-                                if not isinstance(child, Tag):
-                                    continue
-                                if tag_name and not child.name == tag_name:
-                                    continue
-                                yield child
-                        _use_candidate_generator = default_candidate_generator
-                    else:
-                        _use_candidate_generator = lambda tag: tag.descendants
+    def _selector_matchers(self, selector):
+        """Turn a compiled CSS selector into functions that can check
+        the tags beneath this one, one tag at a time.
+
+        :return: A list of 4-tuples (tag name, ID, class, function),
+         one per comma-separated part of the selector's last step, or
+         None if the selector starts with a sibling combinator and so
+         can match tags that aren't beneath this one. The ID, or one
+         of the classes, is given if the part can only match tags
+         with that ID or class. The function returns the tag it's
+         given if the tag matches, and None otherwise.
+        """
+        if selector.steps[0][0] in ('~', '+'):
+            return None
+        last = len(selector.steps) - 1
+        combinator, compounds = selector.steps[last]
+        if last == 0 and combinator is None:
+            follows_steps = None
+        else:
+            memo = {}
+            def follows_steps(tag):
+                return selector._follows_steps(tag, last, self, self, memo)
+
+        matchers = []
+        for tag_name, test, indexed_attribute in compounds:
+            tag_id = klass = None
+            if indexed_attribute is not None:
+                attribute, any_of, all_of = indexed_attribute
+                if attribute == 'id':
+                    tag_id = any_of[0]
                 else:
-                    _use_candidate_generator = _candidate_generator
-
-                for tag in current_context:
-                    if self._select_debug:
-                        print "    Running candidate generator on %s %s" % (
-                            tag.name, repr(tag.attrs))
-                    for candidate in _use_candidate_generator(tag):
-                        if not isinstance(candidate, Tag):
-                            continue
-                        if tag_name and candidate.name != tag_name:
-                            continue
-                        if checker is not None:
-                            try:
-                                result = checker(candidate)
-                            except StopIteration:
-                                # The checker has decided we should no longer
-                                # run the generator.
-                                break
-                        if checker is None or result:
-                            if self._select_debug:
-                                print "     SUCCESS %s %s" % (candidate.name, repr(candidate.attrs))
-                            if id(candidate) not in new_context_ids:
-                                # If a tag matches a selector more than once,
-                                # don't include it in the context more than once.
-                                new_context.append(candidate)
-                                new_context_ids.add(id(candidate))
-                        elif self._select_debug:
-                            print "     FAILURE %s %s" % (candidate.name, repr(candidate.attrs))
-
-
-            current_context = new_context
-
-        if self._select_debug:
-            print "Final verdict:"
-            for i in current_context:
-                print " %s %s" % (i.name, i.attrs)
-        return current_context
+                    klass = min(all_of)
+
+            def matcher(tag, test=test):
+                if not test(tag):
+                    return None
+                if follows_steps is not None and not follows_steps(tag):
+                    return None
+                return tag
+            matchers.append((tag_name, tag_id, klass, matcher))
+        return matchers
+
+    def select(self, selector, limit=None):
+        """Perform a CSS selection operation on the current element.
+
+        :param selector: A CSS selector, or a CSSSelector returned by
+         compile_selector().
+        :param limit: Stop looking after finding this many tags.
+        """
+        if not isinstance(selector, CSSSelector):
+            selector = compile_selector(selector)
+        return selector.select(self, limit)
+
+    def select_one(self, selector):
+        """Perform a CSS selection operation on the current element,
+        and return the first tag that matches, or None."""
+        if not isinstance(selector, CSSSelector):
+            selector = compile_selector(selector)
+        for tag in selector._matches(self):
+            return tag
+        return None
 
     # Old names for backwards compatibility
     def childGenerator(self):
@@ -1427,6 +2825,681 @@ class Tag(PageElement):
                 key))
         return self.has_attr(key)
 
+def _join_blocks(strings, separator, strip, block_separator):
+    """Join strings, putting block_separator wherever a None shows up
+    between two of them and separator everywhere else."""
+    pieces = []
+    boundary = False
+    for string in strings:
+        if string is None:
+            boundary = True
+            continue
+        if strip:
+            string = string.strip()
+            if not string:
+                continue
+        if pieces:
+            if boundary:
+                pieces.append(block_separator)
+            else:
+                pieces.append(separator)
+        boundary = False
+        pieces.append(string)
+    return u"".join(pieces)
+
+
+class TreeIndex(object):
+    """Lookup tables for the strings and tags in a tree.
+
+    Every tag in the tree points to the index through its _index
+    attribute. When something is added to or removed from one of
+    those tags, the index is marked out of date, and a new one will
+    be built the next time it's needed.
+    """
+
+    # The strings that show up in .strings and .get_text() by default.
+    TEXT_TYPES = (NavigableString, CData)
+
+    def __init__(self, root, tags=None):
+        """Index a tree.
+
+        :param tags: If the tags beneath `root` are already known (in
+         document order), they can be passed in, and the tree won't
+         be walked until something needs its strings.
+        """
+        self.root = root
+        self.up_to_date = True
+        self._positions = None
+        self._stripped = None
+        self._boundaries = None
+
+        # Tables for text searches; see _build_text_tables.
+        self._nodes = self._node_positions = None
+        self._values = self._tokens = self._sorted_tokens = None
+
+        # Tables for searches by tag name; see _build_name_tables.
+        self._tag_positions = self._names = None
+
+        # Tables for searches by attribute value, by attribute name;
+        # see _build_attribute_table.
+        self._attribute_tables = {}
+
+        # Pre-order and post-order numbers; see _build_ordinals.
+        self._ordinals = None
+
+        root.__dict__['_index'] = self
+        if tags is None:
+            self._strings, self._tags = self._walk(True)
+        else:
+            self._strings = None
+            self._tags = tags
+            for tag in tags:
+                tag.__dict__['_index'] = self
+
+    def _walk(self, mark):
+        """Find the default strings and the tags beneath the root.
+
+        :param mark: If True, point each tag at this index.
+        """
+        strings = []
+        tags = []
+        root = self.root
+        if not root.contents:
+            return strings, tags
+        add_string = strings.append
+        add_tag = tags.append
+        stop = root._last_descendant().next_element
+        element = root.contents[0]
+        while element is not stop:
+            cls = element.__class__
+            if cls is NavigableString or cls is CData:
+                add_string(element)
+            elif cls is Tag or isinstance(element, Tag):
+                add_tag(element)
+                if mark:
+                    element.__dict__['_index'] = self
+            element = element.next_element
+        return strings, tags
+
+    @property
+    def strings(self):
+        if self._strings is None:
+            self._strings = self._walk(False)[0]
+        return self._strings
+
+    def changed(self):
+        """The tree has changed; this index is no longer usable.
+
+        Everything the index refers to is dropped, so that a piece of
+        the tree that's been extracted doesn't keep the rest of it
+        from being garbage-collected.
+        """
+        self.__dict__.clear()
+        self.up_to_date = False
+
+    def _range(self, tag, strings=None, positions=None):
+        """Find the slice of a list of strings (by default,
+        self.strings) that lies beneath the given tag.
+
+        :param positions: Maps the id() of each string in the list to
+        its position.
+        """
+        if strings is None:
+            strings = self.strings
+            if self._positions is None:
+                self._positions = dict(
+                    zip(map(id, strings), xrange(len(strings))))
+            positions = self._positions
+        if tag is self.root:
+            return 0, len(strings)
+
+        # Look for the first string inside the tag...
+        last = tag._last_descendant()
+        stop = last.next_element
+        element = tag.next_element
+        while element is not stop:
+            start = positions.get(id(element))
+            if start is not None:
+                break
+            element = element.next_element
+        else:
+            return 0, 0
+
+        # ...and the last one.
+        element = last
+        while True:
+            end = positions.get(id(element))
+            if end is not None:
+                return start, end + 1
+            element = element.previous_element
+
+    def strings_for(self, tag, strip=False):
+        """A list of the strings beneath the given tag."""
+        start, end = self._range(tag)
+        if not strip:
+            return self.strings[start:end]
+        if self._stripped is None:
+            self._stripped = [s.strip() for s in self.strings]
+        return filter(None, self._stripped[start:end])
+
+    def get_text(self, tag, separator, strip, block_separator):
+        """Join up the strings beneath the given tag. See Tag.get_text."""
+        if block_separator is None:
+            return separator.join(self.strings_for(tag, strip))
+        if self._boundaries is None:
+            # For each string, True if a block element starts or
+            # ends between it and the string before.
+            self._boundaries = boundaries = []
+            boundary = False
+            for string in self.root._text_nodes(
+                self.TEXT_TYPES, self.root.block_elements):
+                if string is None:
+                    boundary = True
+                else:
+                    boundaries.append(boundary)
+                    boundary = False
+
+        start, end = self._range(tag)
+        def strings():
+            boundaries = self._boundaries
+            for i in xrange(start, end):
+                if boundaries[i]:
+                    yield None
+                yield self.strings[i]
+        return _join_blocks(strings(), separator, strip, block_separator)
+
+    def attributes_changed(self):
+        """Some tag's attributes have changed; forget the attribute
+        tables, but keep everything else."""
+        if self.up_to_date:
+            self._attribute_tables = {}
+
+    def ordinals(self):
+        """Number the root and everything beneath it.
+
+        :return: A 2-tuple of dictionaries mapping the id() of each
+         element to its position in document order (the order in which
+         the elements start), and to its position in the order in which
+         the elements end. One element is beneath another if it starts
+         after the other one, but ends before it.
+        """
+        if self._ordinals is None:
+            self._build_ordinals()
+        return self._ordinals
+
+    def _build_ordinals(self):
+        before = {}
+        after = {}
+        root = self.root
+        # The elements that have started but not yet ended.
+        before[id(root)] = 0
+        open_elements = [root]
+        started = 1
+        ended = 0
+        stop = root._last_descendant().next_element
+        if root.contents:
+            element = root.contents[0]
+        else:
+            element = stop
+        while element is not stop:
+            parent = element.parent
+            while open_elements and open_elements[-1] is not parent:
+                after[id(open_elements.pop())] = ended
+                ended += 1
+            before[id(element)] = started
+            started += 1
+            open_elements.append(element)
+            element = element.next_element
+        while open_elements:
+            after[id(open_elements.pop())] = ended
+            ended += 1
+        self._ordinals = before, after
+
+    def _build_name_tables(self):
+        """Index the tags beneath the root by name."""
+        self._names = names = {}
+        for position, tag in enumerate(self._tags):
+            names.setdefault(tag.name, []).append(position)
+
+    def _tag_position(self, tag):
+        """Find the given tag in self._tags. The root counts as -1."""
+        if tag is self.root:
+            return -1
+        if self._tag_positions is None:
+            tags = self._tags
+            self._tag_positions = dict(zip(map(id, tags), xrange(len(tags))))
+        return self._tag_positions[id(tag)]
+
+    def _tag_range(self, tag):
+        """Find the slice of self._tags that lies beneath the given tag."""
+        if tag is self.root:
+            return 0, len(self._tags)
+        start = self._tag_position(tag) + 1
+        last = tag._last_descendant()
+        while not isinstance(last, Tag):
+            last = last.previous_element
+        return start, self._tag_position(last) + 1
+
+    def _tags_beneath(self, tag, positions):
+        """Turn a sorted list of positions in self._tags into a list
+        of the tags at those positions that are beneath `tag`."""
+        if tag is not self.root:
+            start, end = self._tag_range(tag)
+            positions = positions[
+                bisect_left(positions, start):bisect_left(positions, end)]
+        tags = self._tags
+        return [tags[i] for i in positions]
+
+    def tag_candidates(self, tag, names):
+        """Find the tags beneath `tag` with the given name (or any of a
+        list of names), in document order.
+
+        The caller should still check the names of the tags it gets
+        back.
+        """
+        if self._names is None:
+            self._build_name_tables()
+        if isinstance(names, basestring):
+            positions = self._names.get(names, [])
+        else:
+            found = set()
+            for name in names:
+                found.update(self._names.get(name, ()))
+            positions = sorted(found)
+        return self._tags_beneath(tag, positions)
+
+    def first_tag_named(self, tag, name):
+        """Find the first tag beneath `tag` with the given name, or
+        None if there isn't one."""
+        if self._names is None:
+            self._build_name_tables()
+        positions = self._names.get(name)
+        if not positions:
+            return None
+        start, end = self._tag_range(tag)
+        i = bisect_left(positions, start)
+        if i < len(positions) and positions[i] < end:
+            return self._tags[positions[i]]
+        return None
+
+    def _build_attribute_table(self, attribute):
+        """Index the tags beneath the root by their values for one
+        attribute.
+
+        :return: A 3-tuple (values, unsplit, loose). `values` maps
+         each string value, and each string in a multi-valued
+         attribute's list, to the positions of the tags that have
+         it. `unsplit` holds the positions of the tags whose value is
+         a single string. `loose` holds the positions of the tags
+         whose value can't be indexed, or can change without the
+         index finding out; those tags are always candidates.
+        """
+        values = {}
+        unsplit = []
+        loose = []
+        for position, tag in enumerate(self._tags):
+            attrs = tag.attrs
+            if not isinstance(attrs, AttributeDict) or not attrs._claim(tag):
+                loose.append(position)
+                continue
+            value = attrs.get(attribute)
+            if value is None:
+                continue
+            if isinstance(value, unicode):
+                values.setdefault(value, []).append(position)
+                unsplit.append(position)
+            elif (value.__class__ is AttributeValueList
+                  and value._owner() is tag
+                  and value._unicode_set() is not None):
+                for item in value.value_set:
+                    values.setdefault(item, []).append(position)
+            else:
+                loose.append(position)
+        table = self._attribute_tables[attribute] = (values, unsplit, loose)
+        return table
+
+    def attribute_candidates(self, tag, attribute, any_of=(), all_of=()):
+        """Find the tags beneath `tag` that might have one of the
+        values in `any_of` for the given attribute, or all of the
+        values in `all_of`, in document order.
+
+        A tag whose value is a single string is a candidate whenever
+        `all_of` is given, since the caller may be matching the
+        string some other way. The caller should check the tags it
+        gets back.
+        """
+        table = self._attribute_tables.get(attribute)
+        if table is None:
+            table = self._build_attribute_table(attribute)
+        values, unsplit, loose = table
+        start, end = self._tag_range(tag)
+        def beneath(positions):
+            if not positions:
+                return positions
+            return positions[
+                bisect_left(positions, start):bisect_left(positions, end)]
+
+        # Each of these lists of positions holds candidates.
+        found = []
+        for value in any_of:
+            found.append(beneath(values.get(value, [])))
+        if len(all_of) == 1:
+            for value in all_of:
+                found.append(beneath(values.get(value, [])))
+        elif all_of:
+            common = None
+            for value in all_of:
+                positions = beneath(values.get(value, []))
+                if common is None:
+                    common = set(positions)
+                else:
+                    common.intersection_update(positions)
+                if not common:
+                    break
+            found.append(common)
+        if all_of:
+            found.append(beneath(unsplit))
+        found.append(beneath(loose))
+        found = [positions for positions in found if positions]
+
+        if not found:
+            return []
+        if len(found) == 1 and isinstance(found[0], list):
+            # The common case: an ID, or a single class.
+            positions = found[0]
+        else:
+            positions = set()
+            for candidates in found:
+                positions.update(candidates)
+            positions = sorted(positions)
+        tags = self._tags
+        return [tags[i] for i in positions]
+
+    # Words are indexed both as runs of Unicode word characters and as
+    # runs of ASCII word characters, so that a regular expression's \b
+    # finds the same word boundaries whether or not it was compiled
+    # with re.UNICODE.
+    WORD_RES = (re.compile(r"\w+", re.UNICODE), re.compile(r"[a-zA-Z0-9_]+"))
+
+    def _build_text_tables(self):
+        """Index every NavigableString in the tree (comments and all)
+        by its value and by the words in it."""
+        self._nodes = nodes = [
+            element for element in self.root.descendants
+            if isinstance(element, NavigableString)]
+        self._node_positions = dict(zip(map(id, nodes), xrange(len(nodes))))
+        self._values = values = {}
+        self._tokens = tokens = {}
+        for position, node in enumerate(nodes):
+            values.setdefault(node, []).append(position)
+            words = set()
+            for word_re in self.WORD_RES:
+                words.update(word_re.findall(node))
+            for word in set(word.lower() for word in words):
+                tokens.setdefault(word, []).append(position)
+
+    def text_candidates(self, tag, match_against):
+        """Find the strings beneath `tag` that might match a text
+        search for `match_against`, in document order.
+
+        Literal strings are looked up by value. A regular expression
+        that starts with \\b or ^ followed by a literal word is looked
+        up by that word's prefix. Every string that would match is
+        returned, but so might some that don't.
+
+        :return: A list of NavigableStrings, or None if the index
+        can't help with this kind of search.
+        """
+        if isinstance(match_against, unicode):
+            match_against = [match_against]
+        if isinstance(match_against, list):
+            if not all(isinstance(value, unicode) for value in match_against):
+                return None
+            if self._nodes is None:
+                self._build_text_tables()
+            found = set()
+            for value in match_against:
+                found.update(self._values.get(value, ()))
+        else:
+            prefix = _word_prefix(match_against)
+            if prefix is None:
+                return None
+            if self._nodes is None:
+                self._build_text_tables()
+            if self._sorted_tokens is None:
+                self._sorted_tokens = sorted(self._tokens)
+            tokens = self._sorted_tokens
+            found = set()
+            i = bisect_left(tokens, prefix)
+            while i < len(tokens) and tokens[i].startswith(prefix):
+                found.update(self._tokens[tokens[i]])
+                i += 1
+
+        start, end = self._range(tag, self._nodes, self._node_positions)
+        nodes = self._nodes
+        return [nodes[i] for i in sorted(found) if start <= i < end]
+
+
+_pattern_type = type(re.compile(""))
+# The letters that some non-ASCII character matches when case is
+# ignored: the dotless i and the dotted capital I, the long s, and the
+# Kelvin sign. The tree index keeps words in lowercase, so it can't
+# find those characters by looking up an ASCII prefix.
+_unsafe_ignoring_case = frozenset(u"iIsSkK")
+_word_start_anchors = [
+    (sre_constants.AT, sre_constants.AT_BOUNDARY),
+    (sre_constants.AT, sre_constants.AT_BEGINNING),
+    (sre_constants.AT, sre_constants.AT_BEGINNING_STRING)]
+
+def _word_prefix(pattern):
+    """If every match for a compiled regular expression must begin a
+    word with a certain literal prefix, return that prefix in lowercase.
+
+    For instance, the prefix of \\bfoo(bar|baz) is "foo". If the
+    expression ignores case, the prefix stops short of any character
+    that can match something lower() doesn't turn it into.
+    """
+    if (not isinstance(pattern, _pattern_type)
+        or not isinstance(pattern.pattern, basestring)
+        or pattern.flags & re.LOCALE):
+        return None
+    if pattern.flags & re.UNICODE:
+        word_re = TreeIndex.WORD_RES[0]
+    else:
+        word_re = TreeIndex.WORD_RES[1]
+    try:
+        parsed = list(sre_parse.parse(pattern.pattern, pattern.flags))
+    except Exception:
+        return None
+    if not parsed or parsed[0] not in _word_start_anchors:
+        return None
+    ignore_case = pattern.flags & re.IGNORECASE
+    prefix = []
+    for op, value in parsed[1:]:
+        if op != sre_constants.LITERAL:
+            break
+        char = unichr(value)
+        if word_re.match(char) is None:
+            break
+        if ignore_case and (value > 127 or char in _unsafe_ignoring_case):
+            break
+        prefix.append(char)
+    if not prefix:
+        return None
+    return u"".join(prefix).lower()
+
+
+class TextBuffer(object):
+    """The text of a tag as a single string, along with a map from
+    positions in that string back to NavigableStrings in the tree.
+
+    :ivar text: All the strings, joined together with the separator.
+    :ivar strings: The NavigableStrings, in document order.
+    :ivar offsets: An array of the position in `text` where each
+     string starts.
+    """
+
+    def __init__(self, strings, separator=u""):
+        self.strings = strings
+        self.separator = separator
+        self.text = separator.join(strings)
+        self.offsets = offsets = array('l')
+        position = 0
+        step = len(separator)
+        for string in strings:
+            offsets.append(position)
+            position += len(string) + step
+
+    def string_at(self, position):
+        """Find the NavigableString at a position in the text.
+
+        :return: A 2-tuple (string, position within that string), or
+         None if the position falls inside a separator.
+        """
+        i = bisect_right(self.offsets, position) - 1
+        if i < 0:
+            return None
+        string = self.strings[i]
+        offset = position - self.offsets[i]
+        if offset >= len(string):
+            return None
+        return string, offset
+
+    def locate(self, start, end):
+        """Map a slice of the text back to the tree.
+
+        :return: A list of 3-tuples (string, start, end), one for each
+         NavigableString that overlaps the slice, giving the part of
+         that string that's in the slice.
+        """
+        i = max(bisect_right(self.offsets, start) - 1, 0)
+        return self._locate(start, end, i)[0]
+
+    def _locate(self, start, end, i):
+        """Like locate(), but start looking at the i'th string.
+
+        :return: The spans, and the index of the first string that
+         doesn't end before `start`, so that a series of calls with
+         increasing positions can make a single pass over the strings.
+        """
+        offsets = self.offsets
+        strings = self.strings
+        count = len(strings)
+        while i < count and offsets[i] + len(strings[i]) <= start:
+            i += 1
+        first = i
+        spans = []
+        while i < count and offsets[i] < end:
+            string_start = offsets[i]
+            span_start = max(start, string_start) - string_start
+            span_end = min(end - string_start, len(strings[i]))
+            if span_start < span_end:
+                spans.append((strings[i], span_start, span_end))
+            i += 1
+        return spans, first
+
+    def finditer(self, pattern, flags=0):
+        """Search the text with a regular expression.
+
+        :param pattern: A regular expression, compiled or not.
+
+        :yield: A 2-tuple (match, spans) for every match, where
+         `spans` is what locate() returns for the match.
+        """
+        if not hasattr(pattern, 'finditer'):
+            pattern = re.compile(pattern, flags)
+        i = 0
+        for match in pattern.finditer(self.text):
+            spans, i = self._locate(match.start(), match.end(), i)
+            yield match, spans
+
+    def find_keywords(self, keywords, ignore_case=False, whole_words=False):
+        """Look for any number of keywords in a single pass over the
+        text.
+
+        The keywords are merged into a trie, which is turned into a
+        regular expression, so the text is scanned once no matter how
+        many keywords there are. At each position the longest keyword
+        wins, and matches don't overlap.
+
+        :param whole_words: If True, a keyword must start and end on a
+         word boundary.
+
+        :yield: A 3-tuple (keyword, start, spans) for every match,
+         where `spans` is what locate() returns for the match.
+        """
+        flags = re.UNICODE
+        if ignore_case:
+            flags |= re.IGNORECASE
+        by_text = {}
+        for keyword in keywords:
+            if keyword:
+                if ignore_case:
+                    by_text[keyword.lower()] = keyword
+                else:
+                    by_text[keyword] = keyword
+        if not by_text:
+            return
+        pattern = self._trie_pattern(by_text)
+        if whole_words:
+            pattern = r"\b(?:%s)\b" % pattern
+        for match, spans in self.finditer(re.compile(pattern, flags)):
+            text = match.group(0)
+            if not ignore_case:
+                keyword = by_text[text]
+            else:
+                keyword = by_text.get(text.lower())
+                if keyword is None:
+                    keyword = self._keyword_matching(text, by_text, flags)
+            yield keyword, match.start(), spans
+
+    @staticmethod
+    def _keyword_matching(text, keywords, flags):
+        """Find the keyword that a case-insensitive match came from.
+
+        The regular expression engine's idea of which characters are
+        the same apart from case doesn't always agree with lower()
+        (consider u'\N{LATIN SMALL LETTER LONG S}' and u's'), so this
+        asks the engine.
+        """
+        for keyword in keywords.values():
+            if re.match(re.escape(keyword) + r"\Z", text, flags):
+                return keyword
+
+    @classmethod
+    def _trie_pattern(cls, words):
+        """Turn some strings into a regular expression that matches
+        any of them, preferring the longest."""
+        trie = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = None
+
+        def to_pattern(node):
+            ends_here = '' in node
+            branches = []
+            for char in sorted(key for key in node if key):
+                branch = re.escape(char)
+                child = node[char]
+                # Run a chain of single-child nodes together.
+                while len(child) == 1 and '' not in child:
+                    char = list(child)[0]
+                    branch += re.escape(char)
+                    child = child[char]
+                if child != {'': None}:
+                    branch += to_pattern(child)
+                branches.append(branch)
+            if len(branches) == 1 and not ends_here:
+                return branches[0]
+            pattern = "(?:%s)" % "|".join(branches)
+            if ends_here:
+                pattern += "?"
+            return pattern
+        return to_pattern(trie)
+
+
 # Next, a couple classes to represent queries and their results.
 class SoupStrainer(object):
     """Encapsulates a number of ways of matching a markup element (tag or
@@ -1562,6 +3635,205 @@ class SoupStrainer(object):
                 "I don't know how to match against a %s" % markup.__class__)
         return found
 
+    def __getstate__(self):
+        # The compiled matcher can't be pickled; it'll be rebuilt.
+        state = dict(self.__dict__)
+        state.pop('_compiled', None)
+        return state
+
+    def _compile(self):
+        """Turn this strainer into a function that does the same thing
+        as search() for a Tag or a string.
+
+        search() works out what kind of criteria it has every time
+        it's called. The function is put together once for the
+        criteria this strainer actually has, and is reused until the
+        criteria change, whether they're replaced or changed in place.
+        """
+        criteria = self._criteria()
+        compiled = self.__dict__.get('_compiled')
+        if compiled is not None and compiled[0] == criteria:
+            return compiled[1]
+        name, attrs, text = criteria
+
+        search = self.search
+        if not name and not attrs:
+            match_string = self._compile_value(text)
+        else:
+            match_string = None
+
+        if text and not name and not attrs:
+            # Only strings can match.
+            def matcher(markup):
+                if isinstance(markup, Tag):
+                    return None
+                if isinstance(markup, basestring):
+                    if match_string(markup):
+                        return markup
+                    return None
+                return search(markup)
+        else:
+            match_name = None
+            if name:
+                match_name = self._compile_name(name)
+            attr_tests = [(attr, self._compile_value(match_against))
+                          for attr, match_against in attrs.items()]
+            match_text = None
+            if text:
+                match_text = self._compile_value(text)
+
+            def matcher(markup):
+                if isinstance(markup, Tag):
+                    if match_name is not None and not match_name(markup):
+                        return None
+                    if attr_tests:
+                        get = markup.attrs.get
+                        for attr, test in attr_tests:
+                            if not test(get(attr)):
+                                return None
+                    if match_text is not None and not match_text(markup.string):
+                        return None
+                    return markup
+                if isinstance(markup, basestring):
+                    if match_string is not None and match_string(markup):
+                        return markup
+                    return None
+                return search(markup)
+
+        self._compiled = (criteria, matcher)
+        return matcher
+
+    def _criteria(self):
+        """A copy of this strainer's name, attrs and text criteria,
+        which won't change if the originals are changed in place."""
+        def copy(value):
+            if isinstance(value, list):
+                return list(value)
+            return value
+        attrs = dict(
+            (key, copy(value)) for key, value in self.attrs.items())
+        return copy(self.name), attrs, copy(self.text)
+
+    def _compile_name(self, name):
+        """Make a function that tells whether a Tag matches a name
+        criterion, the way _matches(tag, name) does."""
+        if name is True:
+            return lambda tag: True
+        if isinstance(name, collections.Callable):
+            return name
+        matches = self._matches
+        if isinstance(name, unicode):
+            def match_name(tag):
+                tag_name = tag.name
+                if isinstance(tag_name, unicode):
+                    return tag_name == name
+                return matches(tag, name)
+        elif hasattr(name, 'match'):
+            search = name.search
+            def match_name(tag):
+                tag_name = tag.name
+                if isinstance(tag_name, unicode):
+                    return search(tag_name)
+                return matches(tag, name)
+        elif hasattr(name, '__iter__'):
+            def match_name(tag):
+                tag_name = tag.name
+                if isinstance(tag_name, unicode):
+                    return tag_name in name
+                return matches(tag, name)
+        else:
+            match_name = lambda tag: matches(tag, name)
+        return match_name
+
+    def _compile_value(self, match_against):
+        """Make a function that tells whether a string, or the value of
+        an attribute, matches a criterion, the way
+        _matches(value, match_against) does.
+
+        Unicode strings, and lists of them, are handled directly;
+        anything unusual goes to _matches().
+        """
+        matches = self._matches
+        if match_against is True:
+            def match_value(value):
+                if value is None:
+                    return False
+                if isinstance(value, list) or isinstance(value, tuple):
+                    return matches(value, match_against)
+                return True
+        elif isinstance(match_against, collections.Callable):
+            def match_value(value):
+                if isinstance(value, list) or isinstance(value, tuple):
+                    return matches(value, match_against)
+                return match_against(value)
+        elif isinstance(match_against, unicode):
+            empty = not match_against
+            split = None
+            if ' ' in match_against:
+                # See the special case in _matches.
+                split = whitespace_re.split(match_against)
+            def match_value(value):
+                if isinstance(value, unicode):
+                    return value == match_against
+                if value is None:
+                    return empty
+                if isinstance(value, list) or isinstance(value, tuple):
+                    if split is not None:
+                        return split == value
+                    if value.__class__ is AttributeValueList:
+                        items = value._unicode_set()
+                        if items is not None:
+                            return match_against in items
+                    for item in value:
+                        if isinstance(item, unicode):
+                            if item == match_against:
+                                return True
+                        elif matches(item, match_against):
+                            return True
+                    return False
+                return matches(value, match_against)
+        elif hasattr(match_against, 'match'):
+            search = match_against.search
+            def match_value(value):
+                if isinstance(value, unicode):
+                    return search(value)
+                if isinstance(value, list) or isinstance(value, tuple):
+                    for item in value:
+                        if isinstance(item, unicode):
+                            if search(item):
+                                return True
+                        elif matches(item, match_against):
+                            return True
+                    return False
+                return matches(value, match_against)
+        elif isinstance(match_against, list):
+            empty = not match_against
+            criteria = None
+            if all(isinstance(item, unicode) for item in match_against):
+                criteria = frozenset(match_against)
+            def match_value(value):
+                if isinstance(value, unicode):
+                    return value in match_against
+                if value is None:
+                    return empty
+                if isinstance(value, list) or isinstance(value, tuple):
+                    if (criteria is not None
+                        and value.__class__ is AttributeValueList):
+                        items = value._unicode_set()
+                        if items is not None:
+                            return not items.isdisjoint(criteria)
+                    for item in value:
+                        if isinstance(item, unicode):
+                            if item in match_against:
+                                return True
+                        elif matches(item, match_against):
+                            return True
+                    return False
+                return matches(value, match_against)
+        else:
+            match_value = lambda value: matches(value, match_against)
+        return match_value
+
     def _matches(self, markup, match_against):
         # print u"Matching %s against %s" % (markup, match_against)
         result = False
@@ -1617,9 +3889,372 @@ class SoupStrainer(object):
             return markup in match_against
 
 
+class CSSSelector(object):
+    """A CSS selector that has already been parsed.
+
+    Tag.select() takes one of these in place of a selector string, and
+    uses it without parsing anything. Use compile_selector() to get
+    one.
+
+    A selector is matched from right to left: the tags that match its
+    last step are found, and then each one is checked against the
+    steps before it by looking at its ancestors and earlier siblings.
+    """
+
+    combinators = ['>', '+', '~']
+
+    # How many selectors compile_selector() remembers.
+    cache_size = 256
+    _cache = {}
+    _uses = 0
+    # Held while _cache or _uses is being looked at or changed, since
+    # selectors may be compiled by several threads at once.
+    _cache_lock = threading.Lock()
+
+    def __init__(self, selector):
+        self.selector = selector
+
+        # Each step is a 2-tuple (combinator, compounds). The
+        # combinator is None if the step matches descendants of the
+        # tag that matched the previous step. There's one compound
+        # for each comma-separated part of the step: see
+        # _parse_compound().
+        self.steps = []
+
+        # Remove whitespace directly after the grouping operator ','
+        # then split into tokens.
+        tokens = re.sub(',[\s]*',',', selector).split()
+        if tokens[-1] in self.combinators:
+            raise ValueError(
+                'Final combinator "%s" is missing an argument.' % tokens[-1])
+
+        combinator = None
+        for token_group in tokens:
+            # Grouping selectors, ie: p,a
+            grouped_tokens = token_group.split(',')
+            if '' in grouped_tokens:
+                raise ValueError('Invalid group selection syntax: %s' % token_group)
+            if token_group in self.combinators:
+                if combinator is not None:
+                    raise ValueError(
+                        'Final combinator "%s" is missing an argument.'
+                        % token_group)
+                combinator = token_group
+                continue
+            self.steps.append(
+                (combinator,
+                 [self._parse_compound(token) for token in grouped_tokens]))
+            combinator = None
+
+        # For each step, a function that says whether a tag matches
+        # any of the step's compounds.
+        self._tests = []
+        for combinator, compounds in self.steps:
+            if len(compounds) == 1:
+                test = compounds[0][1]
+            else:
+                tests = [compound[1] for compound in compounds]
+                def test(tag, tests=tests):
+                    for test in tests:
+                        if test(tag):
+                            return True
+                    return False
+            self._tests.append(test)
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.selector)
+
+    @classmethod
+    def compile(cls, selector):
+        """Parse a selector, or reuse one parsed recently."""
+        cache = cls._cache
+        with cls._cache_lock:
+            cls._uses += 1
+            entry = cache.get(selector)
+            if entry is not None:
+                entry[1] = cls._uses
+                return entry[0]
+        # Parsing doesn't touch the cache, so other threads needn't
+        # wait for it.
+        compiled = cls(selector)
+        with cls._cache_lock:
+            if len(cache) >= cls.cache_size:
+                # Forget all but the most recently used half of the
+                # cache.
+                by_last_use = sorted(
+                    cache.items(), key=lambda item: item[1][1])
+                forget = len(by_last_use) - cls.cache_size // 2
+                for key, ignore in by_last_use[:forget]:
+                    del cache[key]
+            cache[selector] = [compiled, cls._uses]
+        return compiled
+
+    def _parse_compound(self, token):
+        """Parse one comma-separated part of a step, like "a.sister".
+
+        :return: A 3-tuple (tag name, test, indexed attribute). The
+         tag name is empty if tags with any name can match. The test
+         is a function that says whether a tag matches. The indexed
+         attribute is set if only tags with certain values for an
+         attribute the tree may have indexed can match: see
+         Tag._attribute_candidates().
+        """
+        tag_name = checker = indexed_attribute = None
+
+        m = PageElement.attribselect_re.match(token)
+        if m is not None:
+            # Attribute selector
+            tag_name, attribute, operator, value = m.groups()
+            checker = PageElement._attribute_checker(
+                operator, attribute, value)
+
+        elif '#' in token:
+            # ID selector
+            tag_name, tag_id = token.split('#', 1)
+            def id_matches(tag):
+                return tag.get('id', None) == tag_id
+            checker = id_matches
+            indexed_attribute = ('id', [tag_id], ())
+
+        elif '.' in token:
+            # Class selector
+            tag_name, klass = token.split('.', 1)
+            classes = frozenset(klass.split('.'))
+            def classes_match(candidate):
+                value = candidate.get('class', [])
+                if value.__class__ is AttributeValueList:
+                    values = value._value_set
+                    if values is None:
+                        values = value.value_set
+                    return classes <= values
+                return classes.issubset(value)
+            checker = classes_match
+            indexed_attribute = ('class', (), classes)
+
+        elif ':' in token:
+            # Pseudo-class
+            tag_name, pseudo = token.split(':', 1)
+            if tag_name == '':
+                raise ValueError(
+                    "A pseudo-class must be prefixed with a tag name.")
+            pseudo_attributes = re.match('([a-zA-Z\d-]+)\(([a-zA-Z\d]+)\)', pseudo)
+            if pseudo_attributes is not None:
+                pseudo_type, pseudo_value = pseudo_attributes.groups()
+                if pseudo_type == 'nth-of-type':
+                    try:
+                        pseudo_value = int(pseudo_value)
+                    except:
+                        raise NotImplementedError(
+                            'Only numeric values are currently supported for the nth-of-type pseudo-class.')
+                    if pseudo_value < 1:
+                        raise ValueError(
+                            'nth-of-type pseudo-class value must be at least 1.')
+                    checker = self._nth_of_type(pseudo_value)
+                else:
+                    raise NotImplementedError(
+                        'Only the following pseudo-classes are implemented: nth-of-type.')
+
+        elif token == '*':
+            # Star selector -- matches everything
+            pass
+        elif PageElement.tag_name_re.match(token):
+            # Just a tag name.
+            tag_name = token
+        else:
+            raise ValueError(
+                'Unsupported or invalid CSS selector: "%s"' % token)
+
+        if checker is None:
+            if tag_name:
+                test = lambda tag: tag.name == tag_name
+            else:
+                test = lambda tag: True
+        elif tag_name:
+            test = lambda tag: tag.name == tag_name and checker(tag)
+        else:
+            test = checker
+        return tag_name, test, indexed_attribute
+
+    @staticmethod
+    def _nth_of_type(destination):
+        """Make a checker for the nth-of-type pseudo-class."""
+        def nth_child_of_type(tag):
+            # Count the earlier siblings with the same name.
+            name = tag.name
+            position = 1
+            sibling = tag.previous_sibling
+            while sibling is not None:
+                if isinstance(sibling, Tag) and sibling.name == name:
+                    position += 1
+                    if position > destination:
+                        return False
+                sibling = sibling.previous_sibling
+            return position == destination
+        return nth_child_of_type
+
+    def select(self, tag, limit=None):
+        """Find the tags that match this selector, starting from the
+        given tag.
+
+        :param limit: Stop looking after finding this many tags.
+        :return: A list of tags, in document order.
+        """
+        matches = self._matches(tag)
+        if limit:
+            matches = islice(matches, limit)
+        return list(matches)
+
+    def _matches(self, root):
+        """Yield the tags that match this selector, in document order."""
+        last = len(self.steps) - 1
+        test = self._tests[last]
+        if self.steps[0][0] in ('~', '+'):
+            # The selector starts from the root's later siblings.
+            boundary = root.parent
+        else:
+            boundary = root
+        if last == 0 and self.steps[0][0] is None:
+            # Any tag beneath the root that passes the test matches.
+            check_steps = False
+        else:
+            check_steps = True
+        memo = {}
+
+        # If every match must have the same name, most candidates can
+        # be ruled out without calling the test.
+        compounds = self.steps[last][1]
+        tag_name = None
+        if len(compounds) == 1:
+            tag_name = compounds[0][0]
+
+        previous = None
+        for candidate in self._candidates(root):
+            if (candidate is previous or not isinstance(candidate, Tag)
+                or (tag_name and candidate.name != tag_name)):
+                continue
+            previous = candidate
+            if test(candidate) and (
+                not check_steps
+                or self._follows_steps(candidate, last, root, boundary, memo)):
+                yield candidate
+
+    def _candidates(self, root):
+        """Find every element that might match the last step, in
+        document order."""
+        combinator = self.steps[0][0]
+        if combinator in ('~', '+'):
+            return self._later_in_parent(root)
+        if len(self.steps) == 1 and combinator == '>':
+            return root.children
+
+        if root._index is None:
+            return root.descendants
+        found = []
+        for tag_name, test, indexed_attribute in self.steps[-1][1]:
+            candidates = None
+            if indexed_attribute is not None:
+                candidates = root._attribute_candidates(*indexed_attribute)
+            if candidates is None and tag_name:
+                candidates = root._search_candidates(tag_name)
+            if candidates is None:
+                return root.descendant_tags
+            found.append(candidates)
+        if len(found) == 1:
+            return found[0]
+
+        # Put together the candidates for each part of a group.
+        before = root._ordinals()[0]
+        candidates = dict(
+            (id(tag), tag) for tags in found for tag in tags).values()
+        candidates.sort(key=lambda tag: before[id(tag)])
+        return candidates
+
+    def _later_in_parent(self, root):
+        """Yield the elements beneath the root's parent that come after
+        the root and everything beneath it."""
+        if root.parent is None:
+            return
+        stop_at = root.parent._last_descendant().next_element
+        element = root._last_descendant().next_element
+        while element is not stop_at:
+            yield element
+            element = element.next_element
+
+    def _follows_steps(self, tag, step, root, boundary, memo):
+        """A tag matches the given step of this selector. Does it also
+        match the steps before it?
+
+        :param boundary: The tag beneath which every tag matching any
+         step must be found: the root, or the root's parent if the
+         selector starts with a sibling combinator.
+        :param memo: A dictionary of the answers already worked out
+         for other tags and steps during this search.
+        """
+        combinator = self.steps[step][0]
+        if step == 0:
+            # This is the first step, so the tag must be related to
+            # the root itself.
+            if combinator is None:
+                return True
+            elif combinator == '>':
+                return tag.parent is root
+            elif combinator == '+':
+                return tag.previous_tag_sibling is root
+            else:
+                for sibling in tag.previous_siblings:
+                    if sibling is root:
+                        return True
+                return False
+
+        if combinator is None:
+            possibilities = tag.parents
+        elif combinator == '>':
+            possibilities = [tag.parent]
+        elif combinator == '+':
+            possibilities = [tag.previous_tag_sibling]
+        else:
+            possibilities = tag.previous_siblings
+
+        step -= 1
+        test = self._tests[step]
+        for possibility in possibilities:
+            if possibility is boundary or possibility is None:
+                break
+            if not isinstance(possibility, Tag):
+                continue
+            key = (id(possibility), step)
+            found = memo.get(key)
+            if found is None:
+                found = memo[key] = bool(
+                    test(possibility) and self._follows_steps(
+                        possibility, step, root, boundary, memo))
+            if found:
+                return True
+        return False
+
+
+def compile_selector(selector):
+    """Parse a CSS selector once, to be used many times.
+
+    :return: A CSSSelector that can be passed into select() in place
+     of the selector string. Selectors are cached, so compiling one
+     that was compiled recently is cheap.
+    """
+    return CSSSelector.compile(selector)
+
+
 class ResultSet(list):
     """A ResultSet is just a list that keeps track of the SoupStrainer
     that created it."""
     def __init__(self, source, result=()):
         super(ResultSet, self).__init__(result)
         self.source = source
+
+    def sort_in_document_order(self):
+        """Sort the elements in the order they appear in their tree.
+
+        :raise ValueError: If the elements aren't all in the same tree.
+        """
+        if len(self) > 1:
+            before = self[0]._ordinals(*self)[0]
+            self.sort(key=lambda element: before[id(element)])
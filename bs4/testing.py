@@ -2,6 +2,7 @@
 
 import copy
 import functools
+import io
 import unittest
 from unittest import TestCase
 from bs4 import BeautifulSoup
@@ -524,6 +525,14 @@ class XMLTreeBuilderSmokeTest(object):
             soup.encode("latin1"),
             b'<?xml version="1.0" encoding="latin1"?>\n<root/>')
 
+    def test_write_includes_docstring(self):
+        soup = self.soup("<root/>")
+        out = io.BytesIO()
+        soup.write(out, "latin1")
+        self.assertEqual(
+            out.getvalue(),
+            b'<?xml version="1.0" encoding="latin1"?>\n<root/>')
+
     def test_large_xml_document(self):
         """A large XML document should come out the same as it went in."""
         markup = (b'<?xml version="1.0" encoding="utf-8"?>\n<root>'
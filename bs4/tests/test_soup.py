@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Tests of Beautiful Soup as a whole."""
 
+import gc
 import logging
 import unittest
 import sys
@@ -48,6 +49,37 @@ class TestConstructor(SoupTest):
         soup = self.soup(data)
         self.assertEqual(u"foo\0bar", soup.h1.string)
 
+    def _gc_states_while_parsing(self, **kwargs):
+        states = []
+        def record(name, attrs=None):
+            states.append(gc.isenabled())
+            return True
+        self.soup("<a><b></b></a>", parse_only=SoupStrainer(record),
+                  **kwargs)
+        return set(states)
+
+    def test_gc_suspended_while_parsing(self):
+        self.assertTrue(gc.isenabled())
+        self.assertEqual(
+            set([False]), self._gc_states_while_parsing(suspend_gc=True))
+        self.assertTrue(gc.isenabled())
+
+    def test_gc_left_alone_by_default(self):
+        self.assertEqual(set([True]), self._gc_states_while_parsing())
+
+    def test_gc_left_off_if_it_was_off(self):
+        gc.disable()
+        try:
+            self._gc_states_while_parsing(suspend_gc=True)
+            self.assertFalse(gc.isenabled())
+        finally:
+            gc.enable()
+
+    def test_with_block_disposes_of_soup(self):
+        with self.soup("<a><b></b></a>") as soup:
+            self.assertEqual("b", soup.a.b.name)
+        self.assertEqual([], soup.contents)
+
 
 class TestWarnings(SoupTest):
 
@@ -142,6 +174,18 @@ class TestEntitySubstitution(unittest.TestCase):
         self.assertEqual(self.sub.substitute_html(s),
                           u"foo&forall;\N{SNOWMAN}&otilde;bar")
 
+    def test_html_substitution_of_text_with_many_entities(self):
+        # Text that's mostly made of characters with named entities
+        # is substituted in one pass, with the same result.
+        s = u"\u03b1\u03b2 \u03b3 & <\u00e9>"
+        self.assertEqual(
+            self.sub.substitute_html(s),
+            u"&alpha;&beta; &gamma; &amp; &lt;&eacute;&gt;")
+
+    def test_html_substitution_of_text_with_nothing_to_substitute(self):
+        s = u"Nothing \N{SNOWMAN} to see here."
+        self.assertEqual(self.sub.substitute_html(s), s)
+
     def test_smart_quote_substitution(self):
         # MS smart quotes are a common source of frustration, so we
         # give them a special test.
@@ -183,6 +227,15 @@ class TestEntitySubstitution(unittest.TestCase):
     def test_xml_quoting_handles_ampersands(self):
         self.assertEqual(self.sub.substitute_xml("AT&T"), "AT&amp;T")
 
+    def test_xml_quoting_handles_ampersands_and_angle_brackets(self):
+        self.assertEqual(
+            self.sub.substitute_xml("<&lt;>&"), "&lt;&amp;lt;&gt;&amp;")
+
+    def test_xml_quoting_containing_entities_handles_angle_brackets(self):
+        self.assertEqual(
+            self.sub.substitute_xml_containing_entities("<foo>"),
+            "&lt;foo&gt;")
+
     def test_xml_quoting_including_ampersands_when_they_are_part_of_an_entity(self):
         self.assertEqual(
             self.sub.substitute_xml("&Aacute;T&T"),
@@ -10,21 +10,36 @@ methods tested here.
 """
 
 import copy
+import gc
+import io
 import pickle
 import re
+import sys
+import threading
+import types
 import warnings
-from bs4 import BeautifulSoup
+import weakref
+from bs4 import (
+    BeautifulSoup,
+    compile_selector,
+)
 from bs4.builder import (
     builder_registry,
     HTMLParserTreeBuilder,
 )
 from bs4.element import (
+    AttributeDict,
+    AttributeValueList,
     CData,
+    CSSSelector,
     Comment,
     Doctype,
+    Formatter,
     NavigableString,
+    ResultSet,
     SoupStrainer,
     Tag,
+    _word_prefix,
 )
 from bs4.testing import (
     SoupTest,
@@ -110,6 +125,36 @@ class TestFindAll(TreeTest):
         self.assertSelects(
             soup.find_all('a', limit=0), ["1", "2", "3", "4", "5"])
 
+    def test_ifind_all_yields_matches_as_theyre_found(self):
+        soup = self.soup("<a>1</a><b>2</b><a>3</a><a>4</a>")
+        looked_at = []
+        def is_a(tag):
+            looked_at.append(tag.string)
+            return tag.name == 'a'
+
+        matches = soup.ifind_all(is_a)
+        self.assertFalse(isinstance(matches, list))
+        self.assertEqual("1", next(matches).string)
+        self.assertEqual(["1"], looked_at)
+        self.assertEqual("3", next(matches).string)
+        self.assertEqual(["1", "2", "3"], looked_at)
+
+        self.assertSelects(list(soup.ifind_all('a')), ["1", "3", "4"])
+        self.assertSelects(list(soup.ifind_all('a', limit=2)), ["1", "3"])
+        self.assertSelects(list(soup.ifind_all(True, limit=2)), ["1", "2"])
+        self.assertEqual([u"2"], list(soup.ifind_all(text="2")))
+
+    def test_lazy_versions_of_other_search_methods(self):
+        soup = self.soup("<div><a>1</a><b>2</b><a>3</a></div><a>4</a>")
+        b = soup.b
+        self.assertSelects(list(b.ifind_all_next('a')), ["3", "4"])
+        self.assertSelects(list(b.ifind_all_next('a', limit=1)), ["3"])
+        self.assertSelects(list(b.ifind_next_siblings('a')), ["3"])
+        self.assertSelects(list(b.ifind_all_previous('a')), ["1"])
+        self.assertSelects(list(b.ifind_previous_siblings(True)), ["1"])
+        self.assertEqual(
+            ["div", "[document]"], [x.name for x in b.ifind_parents()])
+
     def test_calling_a_tag_is_calling_findall(self):
         soup = self.soup("<a>1</a><b>2<a id='foo'>3</a></b>")
         self.assertSelects(soup('a', limit=1), ["1"])
@@ -305,6 +350,14 @@ class TestFindAllByAttribute(TreeTest):
         self.assertSelects(
             soup.find_all("a", small_attribute_value), ["Found it"])
 
+    def test_false_non_dictionary_for_attrs(self):
+        soup = self.soup('<a class="foo">1</a><a>2</a>')
+        # Without a limit, a false value for attrs is ignored...
+        self.assertSelects(soup.find_all("a", None), ["1", "2"])
+        # ...but with one, it finds tags with no class.
+        self.assertSelects(soup.find_all("a", None, limit=5), ["2"])
+        self.assertEqual("2", soup.find("a", None).string)
+
     def test_find_all_with_string_for_attrs_finds_multiple_classes(self):
         soup = self.soup('<a class="foo bar"></a><a class="foo"></a>')
         a, a2 = soup.find_all("a")
@@ -325,6 +378,42 @@ class TestFindAllByAttribute(TreeTest):
         strainer = SoupStrainer(attrs={'id' : 'first'})
         self.assertSelects(tree.find_all(strainer), ['Match.'])
 
+    def test_soupstrainer_is_compiled_until_its_criteria_change(self):
+        tree = self.soup("""
+                         <a id="first">Match.</a>
+                         <a id="second">Non-match.</a>""")
+        strainer = SoupStrainer(attrs={'id' : 'first'})
+        self.assertSelects(tree.find_all(strainer), ['Match.'])
+        self.assertEqual(strainer._compile(), strainer._compile())
+
+        strainer.attrs = {'id': u'second'}
+        self.assertSelects(tree.find_all(strainer), ['Non-match.'])
+
+        # Changes made in place are noticed too.
+        strainer.attrs['id'] = u'first'
+        self.assertSelects(tree.find_all(strainer), ['Match.'])
+
+        # The compiled matcher isn't pickled along with the strainer.
+        loaded = pickle.loads(pickle.dumps(strainer))
+        self.assertFalse('_compiled' in loaded.__dict__)
+        self.assertSelects(tree.find_all(loaded), ['Match.'])
+
+    def test_soupstrainer_changed_in_place_between_searches(self):
+        tree = self.soup('<a class="x" id="1">x</a><a id="2">y</a>'
+                         '<b id="3">z</b>', index_attributes=True)
+        strainer = SoupStrainer('a', attrs={'class': 'x'})
+        self.assertSelects(tree.find_all(strainer), ['x'])
+        strainer.attrs.pop('class')
+        strainer.attrs['id'] = u'2'
+        self.assertSelects(tree.find_all(strainer), ['y'])
+        self.assertSelects(tree.find_all(strainer, limit=1), ['y'])
+
+        strainer = SoupStrainer(['a'], text=[u'y'])
+        self.assertSelects(tree.find_all(strainer), ['y'])
+        strainer.name.append(u'b')
+        strainer.text.append(u'z')
+        self.assertSelects(tree.find_all(strainer), ['y', 'z'])
+
     def test_find_all_with_missing_atribute(self):
         # You can pass in None as the value of an attribute to find_all.
         # This will match tags that do not have that attribute set.
@@ -394,6 +483,295 @@ class TestFindAllByAttribute(TreeTest):
         self.assertEqual([], soup.find_all(id=1, text="bar"))
 
 
+class TestFindAllMany(TreeTest):
+    """Test running several searches in one pass with find_all_many()."""
+
+    def setUp(self):
+        super(TestFindAllMany, self).setUp()
+        self.tree = self.soup(
+            '<div id="main"><a class="x" href="/1">1</a><b class="x y">2</b>'
+            '<p>3</p></div><a id="last" href="http://4/">4</a>')
+
+    def test_each_search_finds_what_it_would_on_its_own(self):
+        strainer = SoupStrainer('a', href=re.compile("^/"))
+        queries = {
+            'links': 'a', 'x': '.x', 'xy': 'b.x.y', 'main': '#main',
+            'local': 'a[href^="/"]', 'a_and_p': 'p,a', 'nested': 'div b',
+            'strainer': strainer, 'names': ['p', 'b'], 'text': SoupStrainer(text="3"),
+            }
+        results = self.tree.find_all_many(queries)
+        self.assertEqual(set(queries.keys()), set(results.keys()))
+        for key, query in queries.items():
+            if isinstance(query, basestring):
+                expect = self.tree.select(query)
+            else:
+                expect = self.tree.find_all(query)
+            self.assertEqual(expect, results[key])
+            self.assertTrue(isinstance(results[key], ResultSet))
+
+        self.assertSelects(results['links'], ["1", "4"])
+        self.assertSelects(results['a_and_p'], ["1", "3", "4"])
+        self.assertEqual(["3"], results['text'])
+        self.assertEqual(strainer, results['strainer'].source)
+
+    def test_search_within_tag(self):
+        results = self.tree.div.find_all_many({'links': 'a', 'last': '#last'})
+        self.assertSelects(results['links'], ["1"])
+        self.assertEqual([], results['last'])
+
+    def test_invalid_selector(self):
+        self.assertRaises(ValueError, self.tree.find_all_many, {'bad': 'a,'})
+
+
+class TestTextIndex(TreeTest):
+    """Test text searches in a tree created with index_text=True."""
+
+    def setUp(self):
+        super(TestTextIndex, self).setUp()
+        self.tree = self.soup(
+            '<div><p>Foo bar</p><p><b>foo</b></p>foo<!--foo--></div>'
+            '<p>Food</p><a>bar foo</a>', index_text=True)
+
+    def test_literal_text(self):
+        self.assertEqual([u"foo", u"foo", u"foo"],
+                         self.tree.find_all(text="foo"))
+        self.assertEqual(4, len(self.tree.find_all(text=["foo", "Food"])))
+        self.assertEqual([], self.tree.find_all(text="fo"))
+
+    def test_tags_with_literal_text(self):
+        self.assertSelects(self.tree.find_all(True, text="foo"),
+                           [u"foo", u"foo"])
+        self.assertSelects(self.tree.find_all('b', text="foo"), [u"foo"])
+        self.assertSelects(
+            self.tree.find_all(SoupStrainer('p', text="Food")), [u"Food"])
+
+    def test_word_prefix(self):
+        self.assertEqual([u"Foo bar", u"Food"],
+                         self.tree.find_all(text=re.compile(r"\bFoo")))
+        self.assertEqual(6, len(
+                self.tree.find_all(text=re.compile(r"\bfoo", re.I))))
+        self.assertEqual([u"Foo bar", u"Food"],
+                         self.tree.find_all(text=re.compile("^F")))
+
+    def test_other_regular_expressions(self):
+        self.assertEqual([u"Food"],
+                         self.tree.find_all(text=re.compile("od")))
+
+    def test_word_prefix_ignoring_case_beyond_ascii(self):
+        # When case is ignored, the long s can match "s", and "k" can
+        # match the Kelvin sign, but lower() doesn't turn one into
+        # the other.
+        markup = (u'<p>\u017fun</p><p>sun</p><p>\u212aelvin</p>'
+                  u'<p>kelvin</p><p>house</p><p>hou\u017fe</p>')
+        indexed = self.soup(markup, index_text=True)
+        plain = self.soup(markup)
+        flags = re.IGNORECASE | re.UNICODE
+        for pattern in (u"\\bs", u"\\bsun", u"\\bk", u"\\b\u212a",
+                        u"\\bhouse", u"\\bhou\u017fe"):
+            expression = re.compile(pattern, flags)
+            self.assertEqual(plain.find_all(text=expression),
+                             indexed.find_all(text=expression))
+
+        self.assertEqual(None, _word_prefix(re.compile(u"\\bsun", flags)))
+        self.assertEqual(None, _word_prefix(re.compile(u"\\bKelvin", flags)))
+        self.assertEqual(u"hou", _word_prefix(re.compile(u"\\bhouse", flags)))
+        self.assertEqual(u"sun", _word_prefix(re.compile(u"\\bsun")))
+
+    def test_search_within_tag(self):
+        self.assertEqual(3, len(self.tree.div.find_all(text="foo")))
+        self.assertEqual([u"foo"], self.tree.b.find_all(text="foo"))
+        self.assertEqual(2, len(
+                self.tree.div.find_all(text="foo", recursive=False)))
+
+    def test_index_reflects_changes(self):
+        self.assertEqual(3, len(self.tree.find_all(text="foo")))
+        self.tree.b.string = "bar"
+        self.tree.a.append("foo")
+        self.assertEqual([u"foo", u"foo", u"foo"],
+                         self.tree.find_all(text="foo"))
+        self.assertEqual(self.tree.a.contents[1],
+                         self.tree.find_all(text="foo")[-1])
+
+
+class TestNameIndex(TreeTest):
+    """Test searches by name in a tree created with index_names=True."""
+
+    def setUp(self):
+        super(TestNameIndex, self).setUp()
+        self.tree = self.soup(
+            '<div id="1"><a>1</a><b><a>2</a></b></div><a>3</a><b>4</b>',
+            index_names=True)
+
+    def test_index_is_built_while_parsing(self):
+        self.assertNotEqual(None, self.tree._index)
+        self.assertEqual(self.tree._index, self.tree.b._index)
+
+    def test_find_all_by_name(self):
+        self.assertSelects(self.tree.find_all('a'), ["1", "2", "3"])
+        self.assertSelects(self.tree('b'), ["2", "4"])
+        self.assertSelects(self.tree.find_all(['b', 'a']),
+                           ["1", "2", "2", "3", "4"])
+        self.assertSelects(self.tree.find_all('a', limit=2), ["1", "2"])
+        self.assertEqual("2", self.tree.b.a.string)
+
+    def test_search_within_tag(self):
+        self.assertSelects(self.tree.div.find_all('a'), ["1", "2"])
+        self.assertSelects(self.tree.div.b.find_all('a'), ["2"])
+        self.assertSelects(self.tree.find_all('b')[1].find_all('a'), [])
+
+    def test_navigation_by_name_uses_index(self):
+        self.assertEqual(None, self.tree._index._names)
+        self.assertEqual("1", self.tree.a.string)
+        self.assertNotEqual(None, self.tree._index._names)
+        self.assertEqual("2", self.tree.b.a.string)
+        self.assertEqual("2", self.tree.div.b.string)
+        self.assertEqual(None, self.tree.div.b.b)
+        self.assertEqual(None, self.tree.find_all('b')[1].a)
+        self.assertEqual(None, self.tree.nonexistent)
+
+        self.tree.div.a.name = "i"
+        self.assertEqual("2", self.tree.a.string)
+        self.assertEqual("1", self.tree.div.i.string)
+
+    def test_index_reflects_changes(self):
+        self.tree.div.b.extract()
+        new_tag = self.tree.new_tag("a")
+        new_tag.string = "new"
+        self.tree.div.insert(0, new_tag)
+        self.assertSelects(self.tree.find_all('a'), ["new", "1", "3"])
+        self.assertSelects(self.tree.div.find_all('a'), ["new", "1"])
+
+    def test_renamed_tag_is_not_found_under_old_name(self):
+        self.tree.div.a.name = "i"
+        self.assertSelects(self.tree.find_all('a'), ["2", "3"])
+
+    def test_renamed_tag_is_found_under_new_name(self):
+        # Search once so the index is built, then rename a tag.
+        self.assertSelects(self.tree.find_all('a'), ["1", "2", "3"])
+        self.tree.div.a.name = "i"
+        self.assertSelects(self.tree.find_all('i'), ["1"])
+        self.tree.i.name = "b"
+        self.assertSelects(self.tree.find_all('b'), ["1", "2", "4"])
+        self.assertEqual([], self.tree.find_all('i'))
+
+
+class TestAttributeIndex(TreeTest):
+    """Test searches by attribute value in a tree created with
+    index_attributes set."""
+
+    def setUp(self):
+        super(TestAttributeIndex, self).setUp()
+        self.tree = self.soup(
+            '<div id="main" class="box"><a class="item">1</a>'
+            '<b class="item big" data-x="y">2</b></div>'
+            '<a id="other" class="item">3</a><b data-x="y">4</b>',
+            index_attributes=['id', 'class', 'data-x'])
+
+    def test_index_attributes_true_means_id_and_class(self):
+        soup = self.soup("<a id='1'></a>", index_attributes=True)
+        self.assertEqual(set(['id', 'class']), soup.index_attributes)
+        self.assertEqual(frozenset(), self.soup("<a></a>").index_attributes)
+
+    def test_find_by_id(self):
+        self.assertEqual("main", self.tree.find(id="main")['id'])
+        self.assertSelects(self.tree.find_all(id="other"), ["3"])
+        self.assertSelects(self.tree.find_all('b', id="other"), [])
+        self.assertEqual(None, self.tree.find(id="nonexistent"))
+
+    def test_find_by_class(self):
+        self.assertSelects(self.tree.find_all(class_="item"), ["1", "2", "3"])
+        self.assertSelects(self.tree.find_all('b', "big"), ["2"])
+        self.assertSelects(self.tree.find_all(class_="item big"), ["2"])
+        self.assertSelects(self.tree.find_all(class_="big item"), [])
+        self.assertSelects(
+            self.tree.find_all(class_=["big", "nonexistent"]), ["2"])
+
+    def test_find_by_other_attribute(self):
+        self.assertSelects(self.tree.find_all(attrs={'data-x': 'y'}),
+                           ["2", "4"])
+        strainer = SoupStrainer(attrs={'data-x': 'y'})
+        self.assertSelects(self.tree.div.find_all(strainer), ["2"])
+
+    def test_select(self):
+        self.assertEqual(["main"], [x['id'] for x in self.tree.select("#main")])
+        self.assertSelects(self.tree.select(".item"), ["1", "2", "3"])
+        self.assertSelects(self.tree.select("b.item.big"), ["2"])
+        self.assertSelects(self.tree.select("div .item"), ["1", "2"])
+        self.assertSelects(self.tree.select("a#other"), ["3"])
+        self.assertSelects(self.tree.select("b#other"), [])
+
+    def test_index_reflects_attribute_changes(self):
+        self.tree.find(id="other")['id'] = "changed"
+        self.assertEqual(None, self.tree.find(id="other"))
+        self.assertSelects(self.tree.select("#changed"), ["3"])
+
+        self.tree.b['class'].remove("big")
+        self.tree.a['class'].append("big")
+        self.assertSelects(self.tree.find_all(class_="big"), ["1"])
+        self.assertSelects(self.tree.select(".big"), ["1"])
+
+        del self.tree.b['data-x']
+        self.assertSelects(self.tree.find_all(attrs={'data-x': 'y'}), ["4"])
+
+    def test_index_reflects_replaced_attributes(self):
+        # Search once so the index is built, then replace a tag's
+        # attributes outright.
+        self.assertEqual("main", self.tree.find(id="main")['id'])
+        old_attrs = self.tree.div.attrs
+        new_attrs = {'id': 'y'}
+        self.tree.div.attrs = new_attrs
+        self.assertTrue(self.tree.div.attrs is new_attrs)
+        self.assertEqual(self.tree.div, self.tree.find(id="y"))
+        self.assertEqual([self.tree.div], self.tree.select("#y"))
+        self.assertEqual(None, self.tree.find(id="main"))
+
+        # Changes to the new dictionary are noticed, even though it's
+        # an ordinary dictionary; changes to the old one are not.
+        new_attrs['id'] = 'z'
+        old_attrs['id'] = 'y'
+        self.assertEqual(None, self.tree.find(id="y"))
+        self.assertEqual(self.tree.div, self.tree.find(id="z"))
+
+        # Two tags can share a dictionary.
+        div, b = self.tree.div, self.tree.b
+        b.attrs = div.attrs
+        self.assertTrue(b.attrs is div.attrs)
+        self.assertEqual([div, b], self.tree.find_all(id="z"))
+        del b['id']
+        self.assertEqual([], self.tree.find_all(id="z"))
+
+        # The same goes for a tag's own AttributeDict.
+        other = self.tree.find(id="other")
+        b.attrs = other.attrs
+        self.assertTrue(isinstance(b.attrs, AttributeDict))
+        self.assertEqual([b, other], self.tree.find_all(id="other"))
+        b['id'] = 'shared'
+        self.assertEqual(None, self.tree.find(id="other"))
+        self.assertEqual([b, other], self.tree.find_all(id="shared"))
+        self.assertEqual([b, other], self.tree.select("#shared"))
+
+    def test_values_the_index_cannot_follow(self):
+        # A plain list can be changed without the index noticing,
+        # so a tag with one is always looked at.
+        self.tree.a['class'] = ["item"]
+        self.tree.a['class'].append("new")
+        self.assertSelects(self.tree.find_all(class_="new"), ["1"])
+        self.assertSelects(self.tree.select(".new"), ["1"])
+
+        self.tree.b['data-x'] = 5
+        self.assertSelects(self.tree.find_all(attrs={'data-x': '5'}), ["2"])
+
+    def test_index_reflects_tree_changes(self):
+        self.tree.div.a.extract()
+        new_tag = self.tree.new_tag("i", id="new")
+        new_tag['class'] = "item"
+        new_tag.string = "new"
+        self.tree.div.insert(0, new_tag)
+        self.assertSelects(self.tree.find_all(class_="item"),
+                           ["new", "2", "3"])
+        self.assertSelects(self.tree.div.select("#new"), ["new"])
+
+
 
 
 class TestIndex(TreeTest):
@@ -513,6 +891,47 @@ class TestNextOperations(ProximityTest):
         self.assertEqual(tag['id'], '3')
         self.assertEqual(contents, "Three")
 
+    def test_next_tag(self):
+        self.assertEqual(self.start.next_tag['id'], "2")
+        self.assertEqual(self.tree.find(text="One").next_tag['id'], "2")
+        self.assertEqual(self.tree.next_tag['id'], "start")
+        self.assertEqual(self.tree.find(id="3").next_tag, None)
+        self.assertEqual(self.tree.find(text="Three").next_tag, None)
+
+    def test_next_tag_after_tree_changes(self):
+        self.start.append(self.tree.new_tag("i"))
+        self.assertEqual(self.start.next_tag.name, "i")
+        self.assertEqual(self.start.next_tag.next_tag['id'], "2")
+        self.tree.find(id="2").extract()
+        self.assertEqual(self.start.next_tag.next_tag['id'], "3")
+
+    def test_descendant_tags(self):
+        body = self.tree.body
+        self.assertEqual(
+            [tag['id'] for tag in body.descendant_tags], ["1", "2", "3"])
+        self.assertEqual(
+            ["head", "body", "b", "b", "b"],
+            [tag.name for tag in self.tree.html.descendant_tags])
+        self.assertEqual([], list(self.start.descendant_tags))
+
+        self.start.append(self.tree.new_tag("i"))
+        self.assertEqual(
+            ["1", "i", "2", "3"],
+            [tag.get('id', tag.name) for tag in body.descendant_tags])
+
+    def test_tags_are_listed_when_first_needed(self):
+        soup = self.soup("<p><a>1</a> <b>2</b></p>")
+        self.assertEqual(None, soup._index)
+        self.assertEqual("1", soup.find('a').string)
+        self.assertEqual(None, soup._index)
+
+        self.assertSelects(soup.find_all(['a', 'b']), ["1", "2"])
+        index = soup._index
+        self.assertNotEqual(None, index)
+        self.assertEqual(index, soup.b._index)
+        self.assertEqual(soup.b, soup.a.next_tag)
+        self.assertEqual(None, soup.b.next_tag)
+
 class TestPreviousOperations(ProximityTest):
 
     def setUp(self):
@@ -592,6 +1011,15 @@ class TestNextSibling(SiblingTest):
         super(TestNextSibling, self).setUp()
         self.start = self.tree.find(id="1")
 
+    def test_next_tag_sibling(self):
+        soup = self.soup("<p><b>1</b> and <i>2</i> and <u>3</u>.</p>")
+        self.assertEqual(soup.b.next_tag_sibling.name, "i")
+        self.assertEqual(soup.b.next_sibling.next_tag_sibling.name, "i")
+        self.assertEqual(soup.u.next_tag_sibling, None)
+        self.assertEqual(soup.b.next_tag_sibling.next_tag_sibling.name, "u")
+        self.assertEqual(soup.u.previous_tag_sibling.name, "i")
+        self.assertEqual(soup.b.previous_tag_sibling, None)
+
     def test_next_sibling_of_root_is_none(self):
         self.assertEqual(self.tree.next_sibling, None)
 
@@ -676,6 +1104,75 @@ class TestPreviousSibling(SiblingTest):
         self.assertEqual(start.find_previous_sibling(text="nonesuch"), None)
 
 
+class TestDocumentOrder(TreeTest):
+
+    def setUp(self):
+        super(TestDocumentOrder, self).setUp()
+        self.tree = self.soup(
+            '<div id="1">one<b id="1.1">two</b></div>'
+            '<div id="2"><i id="2.1">three</i></div>')
+        self.one = self.tree.find(id="1")
+        self.bold = self.tree.find(id="1.1")
+        self.two = self.tree.find(id="2")
+        self.italic = self.tree.find(id="2.1")
+
+    def test_is_ancestor_of(self):
+        self.assertTrue(self.one.is_ancestor_of(self.bold))
+        self.assertTrue(self.one.is_ancestor_of(self.bold.string))
+        self.assertTrue(self.tree.is_ancestor_of(self.italic))
+        self.assertFalse(self.one.is_ancestor_of(self.one))
+        self.assertFalse(self.one.is_ancestor_of(self.italic))
+        self.assertFalse(self.bold.is_ancestor_of(self.one))
+        self.assertFalse(self.bold.string.is_ancestor_of(self.bold))
+
+    def test_compare_document_position(self):
+        self.assertTrue(self.one.compare_document_position(self.two) < 0)
+        self.assertTrue(self.italic.compare_document_position(self.bold) > 0)
+        self.assertTrue(
+            self.one.contents[0].compare_document_position(self.bold) < 0)
+        self.assertEqual(0, self.bold.compare_document_position(self.bold))
+
+    def test_elements_from_different_trees(self):
+        other = self.soup("<b>other</b>")
+        self.assertRaises(
+            ValueError, self.one.compare_document_position, other.b)
+
+    def test_is_ancestor_of_element_in_another_tree(self):
+        other = self.soup("<b>other</b>")
+        self.assertFalse(self.one.is_ancestor_of(other.b))
+        self.assertFalse(other.is_ancestor_of(self.bold))
+        self.assertFalse(self.tree.is_ancestor_of(NavigableString("x")))
+        self.assertFalse(self.tree.is_ancestor_of(self.tree.new_tag("u")))
+        self.assertFalse(NavigableString("x").is_ancestor_of(self.bold))
+
+    def test_positions_follow_changes_to_the_tree(self):
+        self.assertTrue(self.one.compare_document_position(self.two) < 0)
+        self.one.insert_before(self.two)
+        self.assertTrue(self.one.compare_document_position(self.two) > 0)
+
+        self.assertFalse(self.one.is_ancestor_of(self.italic))
+        self.one.append(self.italic)
+        self.assertTrue(self.one.is_ancestor_of(self.italic))
+        self.assertFalse(self.two.is_ancestor_of(self.italic))
+
+        new_tag = self.tree.new_tag("u")
+        self.italic.append(new_tag)
+        self.assertTrue(self.one.is_ancestor_of(new_tag))
+        self.assertTrue(new_tag.compare_document_position(self.bold) > 0)
+
+    def test_sort_result_set_in_document_order(self):
+        results = ResultSet(None, [
+                self.italic, self.bold.string, self.two, self.tree,
+                self.one])
+        results.sort_in_document_order()
+        self.assertEqual(
+            [self.tree, self.one, self.bold.string, self.two, self.italic],
+            results)
+
+        results.append(self.soup("<b>other</b>").b)
+        self.assertRaises(ValueError, results.sort_in_document_order)
+
+
 class TestTagCreation(SoupTest):
     """Test the ability to create new tags."""
     def test_new_tag(self):
@@ -759,6 +1256,52 @@ class TestTreeModification(SoupTest):
                 '<p id="1">Don\'t leave me .</p>\n'
                 '<p id="2">Don\'t leave!<b>here</b></p>'))
 
+    def test_extend(self):
+        soup = self.soup("<a>1</a><b>2<c>3</c></b>")
+        b, c = soup.b, soup.c
+        soup.a.extend([c, "4", b])
+        self.assertEqual(
+            soup.decode(),
+            self.document_for("<a>1<c>3</c>4<b>2</b></a>"))
+        self.assertEqual(soup.a, c.parent)
+        self.assertEqual("4", c.next_sibling)
+        self.assertEqual(b, c.next_sibling.next_element)
+        self.assertEqual(None, b.next_element.next_element)
+        self.assertEqual(["a", "c", "b"], [tag.name for tag in soup(True)])
+
+    def test_insert_many(self):
+        soup = self.soup("<a>1<b>2</b>3</a><c>4</c><d>5</d>")
+        soup.a.insert_many(1, ["x", soup.d, soup.c])
+        self.assertEqual(
+            soup.decode(),
+            self.document_for("<a>1x<d>5</d><c>4</c><b>2</b>3</a>"))
+        self.assertEqual(soup.b, soup.c.next_sibling)
+        self.assertEqual(soup.c, soup.b.previous_sibling)
+        self.assertEqual(soup.b, soup.c.string.next_element)
+
+    def test_insert_many_moves_children_within_tag(self):
+        soup = self.soup("<a><b></b><c></c><d></d><e></e></a>")
+        soup.a.insert_many(3, [soup.e, soup.b])
+        self.assertEqual(
+            soup.decode(),
+            self.document_for("<a><c></c><d></d><e></e><b></b></a>"))
+
+    def test_insert_many_into_itself_raises_exception(self):
+        soup = self.soup("<a></a>")
+        self.assertRaises(ValueError, soup.a.insert_many, 0, [soup.a])
+
+    def test_replace_with_many(self):
+        soup = self.soup("<p>1<b>2</b>3</p><i>4</i>")
+        b = soup.b
+        self.assertEqual(b, b.replace_with_many(["x", soup.i, "y"]))
+        self.assertEqual(
+            soup.decode(), self.document_for("<p>1x<i>4</i>y3</p>"))
+        self.assertEqual(None, b.parent)
+        self.assertEqual(None, b.next_element.next_element)
+        self.assertRaises(ValueError, b.replace_with_many, ["x"])
+        self.assertRaises(
+            ValueError, soup.i.replace_with_many, [soup.p])
+
     def test_replace_with_returns_thing_that_was_replaced(self):
         text = "<a></a><b><c></c></b>"
         soup = self.soup(text)
@@ -1075,12 +1618,79 @@ class TestTreeModification(SoupTest):
         soup.p.clear()
         self.assertEqual(len(soup.p.contents), 0)
         self.assertTrue(hasattr(a, "contents"))
+        self.assertEqual(None, a.parent)
+        self.assertEqual(None, a.previous_element)
+        self.assertEqual(None, a.next_sibling)
+        self.assertEqual(None, a.em.next_element.next_element)
+        self.assertEqual(None, soup.p.next_element)
 
         # clear using decompose()
         em = a.em
         a.clear(decompose=True)
         self.assertEqual(0, len(em.contents))
 
+    def test_decompose_leaves_nothing_for_garbage_collector(self):
+        soup = self.soup(
+            '<p><a class="x y">String <em>Italicized</em></a> another</p>')
+        a = weakref.ref(soup.a)
+        em = weakref.ref(soup.em)
+        gc.disable()
+        try:
+            soup.a.decompose()
+            self.assertEqual(None, a())
+            self.assertEqual(None, em())
+        finally:
+            gc.enable()
+        self.assertEqual("<p> another</p>", soup.p.decode())
+
+    def test_decompose_does_no_work_per_element_in_python(self):
+        # decompose() and dispose() go through the tree in a single
+        # loop, without calling a Python function for every element.
+        soup = self.soup(
+            '<table>%s</table>' % ('<tr><td class="a b">x</td></tr>' * 200))
+        soup.decode()
+        calls = []
+        def profile(frame, event, arg):
+            if event == 'call':
+                calls.append(frame.f_code.co_name)
+        sys.setprofile(profile)
+        try:
+            soup.tr.decompose()
+            soup.table.decompose()
+            soup.dispose()
+        finally:
+            sys.setprofile(None)
+        self.assertTrue(len(calls) < 50, calls)
+
+    def test_decompose_leaves_attributes_alone(self):
+        soup = self.soup('<p><a class="x y" id="1">text</a></p>')
+        attrs = soup.a.attrs
+        soup.a.decompose()
+        self.assertEqual({'class': ['x', 'y'], 'id': '1'}, attrs)
+
+        # The attributes can be given to another tag, and changes to
+        # them are noticed there.
+        soup.p.attrs = attrs
+        self.assertEqual('<p class="x y" id="1"></p>', soup.p.decode())
+        attrs['class'].append('z')
+        self.assertEqual('<p class="x y z" id="1"></p>', soup.p.decode())
+
+    def test_dispose(self):
+        soup = self.soup('<p class="x y">String <em id="z">Italicized</em></p>')
+        soup_ref = weakref.ref(soup)
+        p = weakref.ref(soup.p)
+        em = weakref.ref(soup.em)
+        gc.disable()
+        try:
+            soup.dispose()
+            self.assertEqual([], soup.contents)
+            del soup
+            self.assertEqual(None, soup_ref())
+            self.assertEqual(None, p())
+            self.assertEqual(None, em())
+        finally:
+            gc.enable()
+
     def test_string_set(self):
         """Tag.string = 'string'"""
         soup = self.soup("<a></a> <b><c></c></b>")
@@ -1124,6 +1734,52 @@ class TestElementObjects(SoupTest):
         self.assertEqual(soup.b.i, soup.find('b').find('i'))
         self.assertEqual(soup.a, None)
 
+    def test_contains_goes_by_identity(self):
+        soup = self.soup('<p><b>x</b>y</p><b>x</b>y')
+        p = soup.p
+        inner_b, outer_b = soup.find_all('b')
+        self.assertTrue(inner_b in p)
+        self.assertFalse(outer_b in p)
+        self.assertTrue(p.contents[1] in p)
+        self.assertFalse(soup.contents[-1] in p)
+        self.assertTrue(outer_b in soup)
+        # Something that's not part of a tree is compared by value.
+        self.assertTrue("y" in p)
+        self.assertFalse("x" in p)
+
+    def test_contains_string_not_in_any_tree(self):
+        soup = self.soup('<p>foo</p>')
+        self.assertFalse(NavigableString(u"foo") in soup.p)
+        self.assertFalse(soup.new_string(u"foo") in soup.p)
+        self.assertTrue(soup.p.contains_equal(NavigableString(u"foo")))
+
+    def test_contains_equal(self):
+        soup = self.soup('<p><b>x</b>y</p><b>x</b>y')
+        outer_b = soup.find_all('b')[1]
+        self.assertTrue(soup.p.contains_equal(outer_b))
+        self.assertTrue(soup.p.contains_equal(soup.contents[-1]))
+        self.assertFalse(soup.p.contains_equal(soup.new_tag('b')))
+
+    def test_member_access_stays_beneath_tag(self):
+        soup = self.soup('<p><b>1</b> <i>2</i></p><p>3 <a>4</a></p><a>5</a>')
+        first, second = soup.find_all('p')
+        self.assertEqual(None, first.a)
+        self.assertEqual("4", second.a.string)
+        self.assertTrue(second.a is soup.a)
+        self.assertEqual(None, soup.a.a)
+
+    def test_member_access_after_tree_changes(self):
+        soup = self.soup('<p><b>1</b></p><p><i>2</i></p>')
+        first, second = soup.find_all('p')
+        self.assertEqual(None, first.i)
+        first.append(soup.new_tag("i"))
+        self.assertTrue(first.i is first.contents[-1])
+        first.i.extract()
+        self.assertEqual(None, first.i)
+        second.i.name = "b"
+        self.assertEqual(None, soup.i)
+        self.assertEqual("2", second.b.string)
+
     def test_deprecated_member_access(self):
         soup = self.soup('<b><i></i></b>')
         with warnings.catch_warnings(record=True) as w:
@@ -1210,6 +1866,120 @@ class TestElementObjects(SoupTest):
         soup = self.soup("foo<!--IGNORE-->bar")
         self.assertEqual(['foo', 'bar'], list(soup.strings))
 
+    def test_get_text_with_block_separator(self):
+        soup = self.soup(
+            "<div><p>a<b>b</b></p>  <p>c</p>d<br/>e<ul><li>f</li></ul></div>")
+        self.assertEqual(
+            soup.get_text(" ", strip=True, block_separator="\n"),
+            "a b\nc\nd\ne\nf")
+        self.assertEqual(
+            soup.p.get_text(" ", block_separator="\n"), "a b")
+        # Whitespace between blocks is kept unless strip is set.
+        self.assertEqual(
+            soup.div.get_text(block_separator="|"), "ab| |c|d|e|f")
+
+    def test_text_reflects_tree_changes(self):
+        soup = self.soup("<p>foo<b>bar</b></p><p>baz</p>")
+        self.assertEqual("foobarbaz", soup.get_text())
+        self.assertEqual("bar", soup.b.get_text())
+
+        soup.b.string = "BAR"
+        self.assertEqual("fooBARbaz", soup.get_text())
+        self.assertEqual("BAR", soup.b.get_text())
+
+        soup.p.append(soup.find_all('p')[1])
+        self.assertEqual(["foo", "BAR", "baz"], list(soup.p.strings))
+
+        b = soup.b.extract()
+        self.assertEqual("foobaz", soup.get_text())
+        b.append("!")
+        self.assertEqual("BAR!", b.get_text())
+        self.assertEqual("foobaz", soup.get_text())
+
+    def test_strings_of_a_deep_tree(self):
+        soup = self.soup("<div>" * 2000 + "x" + "</div>" * 2000)
+        self.assertEqual("x", soup.get_text())
+        self.assertEqual("x", soup.div.div.get_text(block_separator="\n"))
+
+    def test_strings_are_only_listed_when_asked_for_twice(self):
+        soup = self.soup("<p>foo<b>bar</b></p><p>baz</p>")
+        strings = soup.p.strings
+        self.assertTrue(isinstance(strings, types.GeneratorType))
+        self.assertEqual(["foo", "bar"], list(strings))
+        self.assertEqual(None, soup.p._index)
+
+        # The second time, the strings beneath the tag are listed,
+        # and the list is used for the tags beneath it, too.
+        self.assertEqual("foobar", soup.p.get_text())
+        index = soup.p._index
+        self.assertNotEqual(None, index._strings)
+        self.assertEqual(index, soup.b._index)
+        self.assertEqual(["bar"], list(soup.b.strings))
+        self.assertEqual(index, soup.b._index)
+
+    def test_strings_are_listed_right_away_with_index_text(self):
+        soup = self.soup("<p>foo<b>bar</b></p>", index_text=True)
+        self.assertEqual("foobar", soup.get_text())
+        self.assertNotEqual(None, soup._index._strings)
+
+
+class TestTextBuffer(SoupTest):
+
+    def setUp(self):
+        super(TestTextBuffer, self).setUp()
+        self.tree = self.soup(
+            "<p>Call <b>555-1234</b> or <i>555</i>-9876.</p><!--555-0000-->")
+        self.buffer = self.tree.text_buffer()
+
+    def test_text_and_offsets(self):
+        self.assertEqual(u"Call 555-1234 or 555-9876.", self.buffer.text)
+        self.assertEqual([0, 5, 13, 17, 20], list(self.buffer.offsets))
+        self.assertEqual(self.tree.b.string, self.buffer.strings[1])
+
+    def test_separator(self):
+        buffer = self.tree.p.text_buffer("|")
+        self.assertEqual(u"Call |555-1234| or |555|-9876.", buffer.text)
+        self.assertEqual((self.tree.i.string, 1), buffer.string_at(21))
+        self.assertEqual(None, buffer.string_at(23))
+
+    def test_locate(self):
+        i = self.tree.i.string
+        dash = self.tree.i.next_sibling
+        self.assertEqual([(i, 1, 3), (dash, 0, 2)],
+                         self.buffer.locate(18, 22))
+
+    def test_finditer(self):
+        found = list(self.buffer.finditer(r"\d{3}-\d{4}"))
+        self.assertEqual([u"555-1234", u"555-9876"],
+                         [match.group(0) for match, spans in found])
+        self.assertEqual([(self.tree.b.string, 0, 8)], found[0][1])
+        self.assertEqual([self.tree.i.string, self.tree.i.next_sibling],
+                         [string for string, start, end in found[1][1]])
+
+    def test_find_keywords(self):
+        found = list(self.buffer.find_keywords(
+                ["555", "555-1234", "CALL", "all"], ignore_case=True))
+        self.assertEqual(
+            [("CALL", 0), ("555-1234", 5), ("555", 17)],
+            [(keyword, start) for keyword, start, spans in found])
+        self.assertEqual([(self.tree.i.string, 0, 3)], found[2][2])
+
+    def test_find_keywords_ignoring_case_beyond_lower(self):
+        # These characters match each other when case is ignored,
+        # even though lower() doesn't turn one into the other.
+        long_s = u"\N{LATIN SMALL LETTER LONG S}"
+        buffer = self.soup(u"<p>Ca%sh or cash</p>" % long_s).text_buffer()
+        found = buffer.find_keywords(["CASH"], ignore_case=True)
+        self.assertEqual([("CASH", 0), ("CASH", 8)],
+                         [(keyword, start) for keyword, start, _ in found])
+        found = buffer.find_keywords([u"ca%sh" % long_s], ignore_case=True)
+        self.assertEqual([0, 8], [start for _, start, _ in found])
+
+    def test_find_whole_words(self):
+        found = self.buffer.find_keywords(["all", "or", "Call"],
+                                          whole_words=True)
+        self.assertEqual(["Call", "or"], [keyword for keyword, _, _ in found])
+
 class TestCDAtaListAttributes(SoupTest):
 
     """Testing cdata-list attributes like 'class'.
@@ -1234,6 +2004,111 @@ class TestCDAtaListAttributes(SoupTest):
         soup = self.soup('<form accept-charset="ISO-8859-1 UTF-8">')
         self.assertEqual(['ISO-8859-1', 'UTF-8'], soup.form['accept-charset'])
 
+    def test_value_set(self):
+        soup = self.soup("<a class='foo bar foo'>")
+        classes = soup.a['class']
+        self.assertEqual(frozenset(["foo", "bar"]), classes.value_set)
+        # The set is kept until the list changes.
+        self.assertTrue(classes.value_set is classes.value_set)
+        classes.append("baz")
+        self.assertEqual(
+            frozenset(["foo", "bar", "baz"]), classes.value_set)
+        classes.remove("foo")
+        classes.remove("foo")
+        self.assertEqual(frozenset(["bar", "baz"]), classes.value_set)
+
+    def test_every_change_to_a_list_value_is_noticed(self):
+        def set_item(l): l[0] = "x"
+        def set_slice(l): l[0:1] = ["x", "y"]
+        def del_item(l): del l[0]
+        def del_slice(l): del l[0:1]
+        def add_in_place(l): l += ["x"]
+        def multiply_in_place(l): l *= 2
+        changes = [
+            set_item, set_slice, del_item, del_slice, add_in_place,
+            multiply_in_place, lambda l: l.append("x"),
+            lambda l: l.extend(["x"]), lambda l: l.insert(0, "x"),
+            lambda l: l.pop(), lambda l: l.remove("b"),
+            lambda l: l.reverse(), lambda l: l.sort(), lambda l: l.clear(),
+        ]
+        for change in changes:
+            soup = BeautifulSoup('<a class="b a"></a>',
+                                 builder=self.default_builder,
+                                 cache_output=True)
+            classes = soup.a['class']
+            soup.decode()
+            classes.value_set
+            change(classes)
+            self.assertEqual(frozenset(classes), classes.value_set)
+            self.assertEqual(
+                '<a class="%s"></a>' % " ".join(classes), soup.decode())
+
+    def test_every_change_to_attributes_is_noticed(self):
+        def set_item(d): d['id'] = "x"
+        def del_item(d): del d['class']
+        def or_in_place(d): d |= {'id': "x"}
+        changes = [
+            set_item, del_item, or_in_place, lambda d: d.clear(),
+            lambda d: d.pop('class'), lambda d: d.popitem(),
+            lambda d: d.setdefault('id', "x"),
+            lambda d: d.update(id="x"),
+        ]
+        for change in changes:
+            soup = BeautifulSoup('<a class="b"></a>',
+                                 builder=self.default_builder,
+                                 cache_output=True)
+            soup.decode()
+            change(soup.a.attrs)
+            self.assertEqual(soup.a.decode(), soup.decode())
+            self.assertNotEqual('<a class="b"></a>', soup.decode())
+
+    def test_copy_of_list_value(self):
+        soup = self.soup('<a class="b a"></a><p></p>')
+        classes = soup.a['class']
+        for copied in (classes.copy(), copy.copy(classes)):
+            self.assertEqual(["b", "a"], copied)
+            self.assertTrue(isinstance(copied, AttributeValueList))
+            self.assertEqual(None, copied._owner())
+        soup.p['class'] = copied
+        soup.decode()
+        self.assertTrue(copied._owner() is soup.p)
+        self.assertTrue(classes._owner() is soup.a)
+
+    def test_attributes_dont_keep_their_tag_alive(self):
+        soup = BeautifulSoup('<p><a class="b" id="c"></a>text</p>',
+                             builder=self.default_builder,
+                             cache_output=True)
+        # Searching and saving output make the tag start listening
+        # for changes to its attributes.
+        soup.find_all(class_="b")
+        soup.decode()
+        attrs = soup.a.attrs
+        classes = attrs['class']
+        a = weakref.ref(soup.a.extract())
+        gc.disable()
+        try:
+            self.assertEqual(None, a())
+        finally:
+            gc.enable()
+        self.assertEqual(None, attrs._owner())
+        self.assertEqual(None, classes._owner())
+        classes.append("d")
+        self.assertEqual({'class': ['b', 'd'], 'id': 'c'}, attrs)
+
+    def test_class_search_sees_changed_values(self):
+        soup = self.soup("<a class='foo bar'></a><b class='bar'></b>")
+        self.assertEqual(["a"], [tag.name for tag in soup.select(".foo.bar")])
+        self.assertEqual(["a"], [tag.name for tag in soup(class_="foo")])
+        soup.a['class'].remove("foo")
+        soup.b['class'].append("foo")
+        self.assertEqual(["b"], [tag.name for tag in soup.select(".foo.bar")])
+        self.assertEqual(
+            ["b"], [tag.name for tag in soup(class_=["foo", "baz"])])
+        soup.b['class'] = ["baz"]
+        self.assertEqual([], soup.select(".foo"))
+        self.assertEqual(
+            ["b"], [tag.name for tag in soup(class_=["foo", "baz"])])
+
     def test_cdata_attribute_applying_only_to_one_tag(self):
         data = '<a accept-charset="ISO-8859-1 UTF-8"></a>'
         soup = self.soup(data)
@@ -1280,6 +2155,14 @@ class TestPersistence(SoupTest):
         self.assertEqual(loaded.__class__, BeautifulSoup)
         self.assertEqual(loaded.decode(), self.tree.decode())
 
+    def test_pickle_after_output(self):
+        # Output leaves rendered start tags lying around, but they
+        # don't get in the way of pickling.
+        output = self.tree.decode()
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            loaded = pickle.loads(pickle.dumps(self.tree, protocol))
+            self.assertEqual(output, loaded.decode())
+
     def test_deepcopy_identity(self):
         # Making a deepcopy of a tree yields an identical tree.
         copied = copy.deepcopy(self.tree)
@@ -1294,6 +2177,167 @@ class TestPersistence(SoupTest):
         self.assertEqual(loaded.decode(), soup.decode())
 
 
+class TestOutputCache(SoupTest):
+    """Test the output cache turned on by cache_output=True."""
+
+    def setUp(self):
+        super(TestOutputCache, self).setUp()
+        self.soup = self.soup(
+            '<div id="main"><p class="a b">One</p><p>Two <b>2</b></p></div>',
+            cache_output=True)
+
+    def test_output_is_saved(self):
+        expect = self.soup.decode()
+        self.assertEqual(expect, self.soup.div._output[-1])
+        self.assertEqual('<b>2</b>', self.soup.b._output[-1])
+        self.assertEqual(expect, self.soup.decode())
+
+    def test_output_is_only_saved_where_it_can_be_reused(self):
+        soup = BeautifulSoup(
+            '<section><div><p>a</p><p>b</p></div></section>',
+            builder=self.default_builder, cache_output=True)
+        soup.decode()
+        # The top of the tree and a tag whose only child is a tag
+        # don't keep a copy of their output.
+        self.assertEqual(None, soup._output[-1])
+        self.assertEqual(None, soup.section._output[-1])
+        self.assertEqual(
+            '<div><p>a</p><p>b</p></div>', soup.div._output[-1])
+
+        # But a change beneath them is still noticed.
+        soup.p.string = "A"
+        self.assertEqual(None, soup.div._output)
+        self.assertEqual(None, soup.section._output)
+        self.assertEqual(
+            '<section><div><p>A</p><p>b</p></div></section>',
+            soup.decode())
+        soup.section.append("c")
+        soup.div.string = "d"
+        self.assertEqual('<section><div>d</div>c</section>', soup.decode())
+
+        # Nor does a tag whose output is mostly one child's output.
+        long_text = "x" * 50
+        soup.div.append(soup.new_tag("p"))
+        soup.div.p.string = long_text
+        soup.decode()
+        self.assertEqual(None, soup.div._output[-1])
+        self.assertEqual("<p>%s</p>" % long_text, soup.div.p._output[-1])
+
+    def test_tags_that_cannot_be_saved(self):
+        soup = BeautifulSoup(
+            '<div><p><b class="x">1</b></p><p>2</p></div><p>3</p>',
+            builder=self.default_builder, cache_output=True)
+        # A plain list can change without anyone noticing, so neither
+        # this tag nor the tags above it can keep their output.
+        soup.b['class'] = ['x']
+        soup.decode()
+        self.assertEqual(None, soup.b._output)
+        self.assertEqual(None, soup.p._output)
+        self.assertEqual(None, soup.div._output)
+        paragraphs = soup.find_all('p')
+        self.assertEqual('<p>2</p>', paragraphs[1]._output[-1])
+        self.assertEqual('<p>3</p>', paragraphs[2]._output[-1])
+
+    def test_changes_to_tag_name_prefix_and_attrs_are_noticed(self):
+        soup = self.soup
+        soup.decode()
+        soup.b.name = "i"
+        self.assertEqual(
+            '<div id="main"><p class="a b">One</p><p>Two <i>2</i></p></div>',
+            soup.decode())
+        soup.i.prefix = "x"
+        self.assertEqual(
+            '<div id="main"><p class="a b">One</p>'
+            '<p>Two <x:i>2</x:i></p></div>', soup.decode())
+        soup.p.attrs = {'id': 'first'}
+        self.assertEqual(
+            '<div id="main"><p id="first">One</p>'
+            '<p>Two <x:i>2</x:i></p></div>', soup.decode())
+        soup.i.hidden = True
+        self.assertEqual(
+            '<div id="main"><p id="first">One</p><p>Two 2</p></div>',
+            soup.decode())
+
+    def test_shared_and_plain_attribute_dictionaries(self):
+        soup = BeautifulSoup('<p><a id="1">x</a></p><p><b>y</b></p>',
+                             builder=self.default_builder,
+                             cache_output=True)
+        soup.decode()
+        soup.b.attrs = soup.a.attrs
+        self.assertEqual(
+            '<p><a id="1">x</a></p><p><b id="1">y</b></p>', soup.decode())
+        soup.b['id'] = '2'
+        self.assertEqual(
+            '<p><a id="2">x</a></p><p><b id="2">y</b></p>', soup.decode())
+
+        attrs = {'id': '3'}
+        soup.a.attrs = attrs
+        soup.decode()
+        attrs['id'] = '4'
+        self.assertEqual(
+            '<p><a id="4">x</a></p><p><b id="2">y</b></p>', soup.decode())
+
+    def test_output_is_not_saved_by_default(self):
+        soup = BeautifulSoup("<p>foo</p>", builder=self.default_builder)
+        soup.decode()
+        self.assertEqual(None, soup.p._output)
+
+    def test_output_is_saved_for_each_formatter_and_indent_level(self):
+        self.soup.decode()
+        self.assertEqual(
+            '<div id="main">\n <p class="a b">\n  One\n </p>\n'
+            ' <p>\n  Two\n  <b>\n   2\n  </b>\n </p>\n</div>',
+            self.soup.div.prettify())
+        self.assertEqual(
+            '<div id="MAIN"><p class="A B">ONE</p>'
+            '<p>TWO <b>2</b></p></div>',
+            self.soup.div.decode(formatter=lambda s: s.upper()))
+
+    def test_changes_are_noticed(self):
+        soup = self.soup
+        soup.decode()
+        soup.b.string = "two"
+        soup.p['class'].append('c')
+        soup.div['id'] = 'new'
+        self.assertEqual(
+            '<div id="new"><p class="a b c">One</p>'
+            '<p>Two <b>two</b></p></div>', soup.decode())
+
+        soup.b.extract()
+        soup.p.insert(0, soup.new_tag("i"))
+        del soup.div['id']
+        self.assertEqual(
+            '<div><p class="a b c"><i></i>One</p><p>Two </p></div>',
+            soup.decode())
+
+    def test_change_to_unobserved_list_is_noticed(self):
+        soup = self.soup
+        soup.decode()
+        classes = ['x']
+        soup.p['class'] = classes
+        self.assertEqual('<p class="x">One</p>', soup.p.decode())
+        classes.append('y')
+        self.assertEqual('<p class="x y">One</p>', soup.p.decode())
+        self.assertTrue(
+            '<p class="x y">One</p>' in soup.decode())
+
+    def test_moved_tag_keeps_its_output(self):
+        soup = self.soup
+        soup.decode()
+        b = soup.b
+        soup.p.append(b)
+        self.assertEqual('<b>2</b>', b._output[-1])
+        self.assertEqual(
+            '<div id="main"><p class="a b">One<b>2</b></p>'
+            '<p>Two </p></div>', soup.decode())
+
+    def test_pickle_with_saved_output(self):
+        output = self.soup.decode()
+        loaded = pickle.loads(pickle.dumps(self.soup, 2))
+        self.assertEqual(None, loaded.div._output)
+        self.assertEqual(output, loaded.decode())
+
+
 class TestSubstitutions(SoupTest):
 
     def test_default_formatter_is_minimal(self):
@@ -1343,6 +2387,63 @@ class TestSubstitutions(SoupTest):
             decoded,
             self.document_for(u"<b><FOO></b><b>BAR</b>"))
 
+    def test_formatter_object(self):
+        markup = u"<div><textarea> foo\n  bar</textarea><pre> baz </pre></div>"
+        soup = self.soup(markup)
+        formatter = Formatter(
+            lambda x: x.upper(), preformatted_tags=set(["pre", "textarea"]))
+        self.assertEqual(
+            u'<div>\n <textarea> FOO\n  BAR</textarea>\n <pre> BAZ </pre>\n</div>',
+            soup.div.prettify(formatter=formatter))
+
+    def test_formatter_object_knows_whether_tree_is_xml(self):
+        soup = self.soup(u"<div><pre>foo</pre></div>")
+        self.assertEqual(
+            u'<div>\n <pre>foo</pre>\n</div>', soup.div.prettify())
+        # In an XML document, <pre> is just another tag.
+        self.assertTrue(
+            u'<pre>\n' in soup.div.prettify(formatter=Formatter(is_xml=True)))
+
+    def test_formatter_object_can_leave_attributes_unsorted(self):
+        soup = self.soup('<a b="1" a="2" c="3">foo</a>')
+        formatter = Formatter(sort_attributes=False)
+        expect = '<a %s>foo</a>' % ' '.join(
+            '%s="%s"' % item for item in soup.a.attrs.items())
+        self.assertEqual(expect, soup.a.decode(formatter=formatter))
+        self.assertEqual(
+            '<a a="2" b="1" c="3">foo</a>', soup.a.decode())
+
+    def test_start_tag_reflects_changes_since_last_output(self):
+        soup = self.soup('<a class="foo" id="x" href="y">z</a>')
+        a = soup.a
+        self.assertEqual(
+            '<a class="foo" href="y" id="x">z</a>', a.decode())
+
+        a['id'] = 'new'
+        del a['href']
+        self.assertEqual('<a class="foo" id="new">z</a>', a.decode())
+
+        a['class'].append('bar')
+        self.assertEqual('<a class="foo bar" id="new">z</a>', a.decode())
+
+        a.attrs.update(title="t")
+        a.attrs.pop('id')
+        self.assertEqual('<a class="foo bar" title="t">z</a>', a.decode())
+
+        a.name = 'b'
+        a.prefix = 'ns'
+        self.assertEqual(
+            '<ns:b class="foo bar" title="t">z</ns:b>', a.decode())
+
+        a.attrs = {'id': 'replaced'}
+        self.assertEqual('<ns:b id="replaced">z</ns:b>', a.decode())
+
+    def test_start_tag_reflects_tag_becoming_empty(self):
+        soup = self.soup('<br id="x">')
+        self.assertEqual('<br id="x"/>', soup.br.decode())
+        soup.br.append("foo")
+        self.assertEqual('<br id="x">foo</br>', soup.br.decode())
+
     def test_formatter_is_run_on_attribute_values(self):
         markup = u'<a href="http://a.com?a=b&c=é">e</a>'
         soup = self.soup(markup)
@@ -1484,6 +2585,63 @@ class TestEncoding(SoupTest):
         self.assertEqual(
             u"\N{SNOWMAN}".encode("utf8"), soup.b.renderContents())
 
+    def test_write(self):
+        html = u"<div><b>\N{SNOWMAN}</b><p>a &amp; b</p></div>"
+        soup = self.soup(html)
+        for obj in (soup, soup.div):
+            out = io.BytesIO()
+            obj.write(out)
+            self.assertEqual(obj.encode(), out.getvalue())
+
+            out = io.BytesIO()
+            obj.write(out, "ascii", formatter="html", pretty_print=True)
+            self.assertEqual(
+                obj.prettify("ascii", formatter="html"), out.getvalue())
+
+    def test_write_unicode(self):
+        soup = self.soup(u"<b>\N{SNOWMAN}</b>")
+        out = io.StringIO()
+        soup.b.write(out, None)
+        self.assertEqual(u"<b>\N{SNOWMAN}</b>", out.getvalue())
+
+    def test_write_in_small_chunks(self):
+        soup = self.soup("<div><p>foo<b>bar</b></p><p>baz</p></div>")
+        chunks = []
+        class Writer(object):
+            def write(self, data):
+                chunks.append(data)
+        soup.WRITE_CHUNK_SIZE = 1
+        soup.write(Writer(), pretty_print=True)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(soup.prettify("utf8"), b"".join(chunks))
+
+    def test_write_only_writes_one_byte_order_mark(self):
+        soup = self.soup("<div><p>foo</p><p>bar</p></div>")
+        soup.WRITE_CHUNK_SIZE = 1
+        out = io.BytesIO()
+        soup.write(out, "utf-16")
+        self.assertEqual(soup.encode("utf-16"), out.getvalue())
+
+    def test_deeply_nested_tags_can_be_output(self):
+        # Output doesn't recurse, so it isn't limited by the
+        # interpreter's recursion limit.
+        depth = sys.getrecursionlimit() + 100
+        soup = self.soup("<div>" * depth + "x" + "</div>" * depth)
+        self.assertEqual(
+            "<div>" * depth + "x" + "</div>" * depth, soup.decode())
+        self.assertEqual(
+            ("<div>" * depth + "x" + "</div>" * depth).encode("utf8"),
+            soup.encode("utf8"))
+        self.assertEqual(
+            "<div>" * (depth - 1) + "x" + "</div>" * (depth - 1),
+            soup.div.decode_contents())
+
+        pretty = soup.prettify()
+        lines = pretty.splitlines()
+        self.assertEqual(2 * depth + 1, len(lines))
+        self.assertEqual(" " * depth + "x", lines[depth])
+        self.assertEqual(" " * (depth - 1) + "</div>", lines[depth + 1])
+
 class TestNavigableStringSubclasses(SoupTest):
 
     def test_cdata(self):
@@ -1818,6 +2976,12 @@ class TestSoupSelector(TreeTest):
     def test_id_child_selector_nth_of_type(self):
         self.assertSelects('#inner > p:nth-of-type(2)', ['p1'])
 
+    def test_nth_of_type_counts_each_tags_siblings(self):
+        # Each <z> tag is counted among the tags that share its
+        # parent, not among every <z> tag in the document.
+        self.assertSelects('z:nth-of-type(1)', ['zida', 'zidb'])
+        self.assertSelects('div z:nth-of-type(2)', ['zidab'])
+
     def test_select_on_element(self):
         # Other tests operate on the tree; this operates on an element
         # within the tree.
@@ -1850,6 +3014,18 @@ class TestSoupSelector(TreeTest):
     def test_sibling_combinator_wont_select_same_tag_twice(self):
         self.assertSelects('p[lang] ~ p', ['lang-en-gb', 'lang-en-us', 'lang-fr'])
 
+    def test_combinator_relative_to_element(self):
+        p1 = self.soup.find(id='p1')
+        self.assertSelectsIDs(p1.select('~ h2'), ['header2', 'header3'])
+        self.assertSelectsIDs(p1.select('+ h2'), ['header2'])
+        self.assertSelectsIDs(p1.select('~ span > a'), ['s1a1', 's1a2'])
+        self.assertSelectsIDs(p1.select('~ span a span'), ['s1a2s1'])
+        inner = self.soup.find(id='inner')
+        self.assertSelectsIDs(inner.select('> p ~ a'), ['bob', 'me'])
+        self.assertSelectsIDs(inner.select('> span a'),
+                              ['s1a1', 's1a2', 's2a1'])
+        self.assertEqual([], inner.select('> a span'))
+
     # Test the selector grouping operator (the comma)
     def test_multiple_select(self):
         self.assertSelects('x, y',['xid','yid'])
@@ -1885,5 +3061,96 @@ class TestSoupSelector(TreeTest):
     def test_multiple_select_nested(self):
         self.assertSelects('body > div > x, y > z', ['zida', 'zidb', 'zidab', 'zidac'])
 
+    def test_results_are_in_document_order(self):
+        self.assertSelectsIDs(
+            self.soup.select('y, x'), ['xid', 'yid'])
+        self.assertSelectsIDs(
+            self.soup.select('#zidb, #zidab, #zida'), ['zida', 'zidab', 'zidb'])
+        self.assertSelectsIDs(
+            self.soup.select('h2, #p1, h1'),
+            ['header1', 'p1', 'header2', 'header3'])
+
+    def test_select_one(self):
+        self.assertEqual('header2', self.soup.select_one('h2')['id'])
+        self.assertEqual('header1', self.soup.select_one('h2, h1')['id'])
+        self.assertEqual('s1a2s1', self.soup.select_one('a > span')['id'])
+        self.assertEqual(None, self.soup.select_one('span > h2'))
+        self.assertEqual(None, self.soup.select_one('#doesnotexist'))
+        inner = self.soup.find(id='inner')
+        self.assertEqual('bob', inner.select_one('> p ~ a')['id'])
+        self.assertEqual(
+            'header3', self.soup.select_one(compile_selector('#bob ~ h2'))['id'])
 
-
+    def test_select_with_limit(self):
+        self.assertSelectsIDs(
+            self.soup.select('p[lang]', limit=2), ['lang-en', 'lang-en-gb'])
+        self.assertSelectsIDs(
+            self.soup.select('h2, #p1, h1', limit=2), ['header1', 'p1'])
+        self.assertSelectsIDs(
+            self.soup.select('z', limit=10), ['zida', 'zidab', 'zidac', 'zidb'])
+        self.assertEqual(4, len(self.soup.select('[lang]', limit=None)))
+
+    def test_deeply_nested_selection(self):
+        markup = '<div><a id="a%d">%s</a></div>'
+        inner = ''
+        for i in range(50):
+            inner = markup % (i, inner)
+        soup = BeautifulSoup(inner, 'html.parser')
+        self.assertEqual(49, len(soup.select('div div a')))
+        self.assertEqual('a48', soup.select('div > a > div a')[0]['id'])
+
+    def test_compiled_selector(self):
+        selector = compile_selector('div > x, y')
+        self.assertTrue(isinstance(selector, CSSSelector))
+        self.assertEqual(
+            self.soup.select('div > x, y'), self.soup.select(selector))
+        self.assertEqual(['xid', 'yid'],
+                         [el['id'] for el in self.soup.select(selector)])
+        inner = self.soup.find(id='inner')
+        self.assertEqual(inner.select('p'), inner.select(compile_selector('p')))
+
+    def test_compile_selector_reuses_recent_selectors(self):
+        self.assertTrue(compile_selector('p.onep') is compile_selector('p.onep'))
+
+    def test_selector_cache_is_bounded(self):
+        old_size = CSSSelector.cache_size
+        CSSSelector.cache_size = 10
+        try:
+            frequent = compile_selector('p#lang-en')
+            for i in range(50):
+                compile_selector('p#id%d' % i)
+                compile_selector('p#lang-en')
+                self.assertTrue(len(CSSSelector._cache) <= 10)
+            self.assertTrue(compile_selector('p#lang-en') is frequent)
+        finally:
+            CSSSelector.cache_size = old_size
+
+    def test_selectors_can_be_compiled_by_several_threads(self):
+        old_size = CSSSelector.cache_size
+        CSSSelector.cache_size = 10
+        errors = []
+        def compile_many(n):
+            try:
+                for i in range(200):
+                    selector = 'p#id%d' % ((i * n) % 30)
+                    self.assertEqual(
+                        selector, compile_selector(selector).selector)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=compile_many, args=(n,))
+                   for n in range(1, 5)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            CSSSelector.cache_size = old_size
+        self.assertEqual([], errors)
+        self.assertTrue(len(CSSSelector._cache) <= 10)
+
+    def test_invalid_selector_wont_compile(self):
+        self.assertRaises(ValueError, compile_selector, 'h1 >')
+        self.assertRaises(ValueError, compile_selector, 'x,,y')
+        self.assertRaises(ValueError, compile_selector, 'div > > p')
+        self.assertRaises(NotImplementedError, compile_selector, 'p:first-child(1)')